@@ -42,16 +42,18 @@ Legalese:
 import argparse
 import datetime
 import json
-import gzip
 import logging
 import os
 import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import glob
-import gzip
+import hashlib
+import itertools
+import multiprocessing
 import random
 
 from distutils.version import LooseVersion as V
@@ -60,15 +62,16 @@ import requests
 from six import iteritems
 
 try:
-    from BeautifulSoup import BeautifulSoup
+    from BeautifulSoup import BeautifulSoup as BeautifulSoup_
+    HTML_PARSERS = []
 except ImportError:
     from bs4 import BeautifulSoup as BeautifulSoup_
-    try:
-        # Use html5lib for parsing if available
-        import html5lib
-        BeautifulSoup = lambda page: BeautifulSoup_(page, 'html5lib')
-    except ImportError:
-        BeautifulSoup = lambda page: BeautifulSoup_(page, 'html.parser')
+    from bs4 import SoupStrainer
+    from bs4.builder import builder_registry
+
+    # The tree builders of bs4 that are installed, fastest first
+    HTML_PARSERS = [name for name in ('lxml', 'html.parser', 'html5lib')
+                    if builder_registry.lookup(name)]
 
 
 from .cookies import (
@@ -76,9 +79,13 @@ from .cookies import (
     get_cookies_for_class, make_cookie_values)
 from .credentials import get_credentials, CredentialsError
 from .define import CLASS_URL, ABOUT_URL, THREAD_URL, PATH_CACHE
-from .downloaders import get_downloader, is_native_downloader
-from .forum import get_json_dir, generate_forum
-from .utils import clean_filename, get_anchor_format, mkdir_p, fix_url
+from .downloaders import conditional_headers, get_downloader
+from .forum import get_json_dir, generate_forum, FORUM_INDEX_FN
+from .forum import PageStore, get_page_store_path
+from .manifest import Manifest, get_manifest_path
+from .utils import (
+    clean_filename, get_anchor_format, mkdir_p, fix_url, run_in_threads,
+    TokenBucket)
 
 # URL containing information about outdated modules
 _see_url = " See https://github.com/coursera-dl/coursera/issues/139"
@@ -93,6 +100,45 @@ assert V(six.__version__) >= V('1.3'), "Upgrade six!" + _see_url
 assert V(bs4.__version__) >= V('4.1'), "Upgrade bs4!" + _see_url
 
 
+# Number of video pages looked up at the same time while parsing a syllabus
+VIDEO_LOOKUP_JOBS = 4
+
+# Videos found on lecture pages are remembered for this many seconds
+VIDEO_CACHE_FN = os.path.join(PATH_CACHE, 'videos.json')
+VIDEO_CACHE_TTL = 7 * 24 * 3600
+VIDEO_CACHE_SIZE = 10000
+
+
+# The tree builder used, see set_html_parser
+html_parser = HTML_PARSERS[0] if HTML_PARSERS else None
+
+
+def set_html_parser(name):
+    """
+    Use the given tree builder ('lxml', 'html.parser' or 'html5lib') to
+    parse pages.
+    """
+    global html_parser
+    if name not in HTML_PARSERS:
+        raise ValueError('HTML parser not available: %s' % name)
+    html_parser = name
+
+
+def BeautifulSoup(page, only_class=None):
+    """
+    Parse page.  If only_class is given, only the elements with that class
+    (and their contents) are kept, which is much faster for large pages
+    when the tree builder supports it.
+    """
+    if not HTML_PARSERS:
+        # BeautifulSoup 3 has a single parser
+        return BeautifulSoup_(page)
+    parse_only = None
+    if only_class and html_parser != 'html5lib':
+        parse_only = SoupStrainer(attrs={'class': only_class})
+    return BeautifulSoup_(page, html_parser, parse_only=parse_only)
+
+
 def get_syllabus_url(class_name, preview):
     """
     Return the Coursera index/syllabus URL, depending on if we want to only
@@ -139,7 +185,47 @@ def grab_hidden_video_url(session, href):
         return None
 
 
-def get_syllabus(session, class_name, local_page=False, preview=False):
+def get_page_if_modified(session, url, cache_fn):
+    """
+    Download an HTML page with a conditional request, using the page and
+    the validators of the previous response stored in cache_fn.
+    """
+
+    cached = None
+    headers = {}
+    if os.path.exists(cache_fn):
+        try:
+            with open(cache_fn) as f:
+                cached = json.load(f)
+            headers = conditional_headers(cached)
+        except ValueError:
+            logging.debug('Ignoring bad page cache %s', cache_fn)
+
+    r = session.get(url, headers=headers)
+
+    if cached and r.status_code == 304:
+        logging.info('Not modified: %s', url)
+        return cached['page']
+
+    try:
+        r.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        logging.error("Error %s getting page %s", e, url)
+        raise
+
+    if r.headers.get('etag') or r.headers.get('last-modified'):
+        mkdir_p(os.path.dirname(cache_fn))
+        with open(cache_fn, 'w') as f:
+            json.dump({'url': url,
+                       'etag': r.headers.get('etag'),
+                       'last_modified': r.headers.get('last-modified'),
+                       'page': r.text}, f)
+
+    return r.text
+
+
+def get_syllabus(session, class_name, local_page=False, preview=False,
+                 conditional=False):
     """
     Get the course listing webpage.
 
@@ -147,11 +233,21 @@ def get_syllabus(session, class_name, local_page=False, preview=False):
     that page is used instead of performing a download.  If we are
     instructed to use a local page and it does not exist, then we download
     the page and save a copy of it for future use.
+
+    If conditional is set, the page is only downloaded again if it
+    changed since the last run.
     """
 
     if not (local_page and os.path.exists(local_page)):
         url = get_syllabus_url(class_name, preview)
-        page = get_page(session, url)
+        if conditional:
+            cache_fn = os.path.join(
+                PATH_CACHE, 'pages',
+                '{0}-{1}.json'.format(class_name,
+                                      'preview' if preview else 'index'))
+            page = get_page_if_modified(session, url, cache_fn)
+        else:
+            page = get_page(session, url)
         logging.info('Downloaded %s (%d bytes)', url, len(page))
 
         # cache the page if we're in 'local' mode
@@ -193,14 +289,138 @@ def get_video(session, url):
     return soup.find(attrs={'type': re.compile('^video/mp4')})['src']
 
 
-def parse_syllabus(session, page, reverse=False, intact_fnames=False):
+class PendingVideo(object):
+    """
+    Placeholder for the video of a preview lecture page, which is looked up
+    once the whole syllabus has been walked.
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+
+class VideoCache(object):
+    """
+    Videos found on the lecture pages of a class by earlier runs, kept in a
+    JSON file shared by all classes.  Entries expire after `ttl` seconds
+    and only the `max_entries` most recent ones are saved.
+    """
+
+    # held while the shared file is rewritten, as classes may be downloaded
+    # concurrently
+    _save_lock = threading.Lock()
+
+    def __init__(self, filename, class_name, ttl=VIDEO_CACHE_TTL,
+                 max_entries=VIDEO_CACHE_SIZE, clock=time.time):
+        self.filename = filename
+        self.class_name = class_name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = {}
+        self._changed = False
+        self._lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except ValueError:
+            logging.warn('Ignoring broken video cache %s', self.filename)
+            return {}
+
+    def _key(self, url):
+        return self.class_name + ' ' + url
+
+    def get(self, url):
+        """
+        Return the cached video of the page at url, or None.
+        """
+        entry = self.entries.get(self._key(url))
+        if entry is None or entry[1] + self.ttl < self.clock():
+            return None
+        return entry[0]
+
+    def put(self, url, video):
+        with self._lock:
+            self.entries[self._key(url)] = [video, self.clock()]
+            self._changed = True
+
+    def save(self):
+        """
+        Save the entries that have not expired, if anything was added.
+        Entries saved meanwhile by other classes are kept.
+        """
+        if not self._changed:
+            return
+        with self._lock, VideoCache._save_lock:
+            now = self.clock()
+            merged = self._load()
+            merged.update(self.entries)
+            entries = sorted(
+                ((entry[1], key, entry[0])
+                 for key, entry in merged.items()
+                 if entry[1] + self.ttl >= now),
+                reverse=True)[:self.max_entries]
+            self.entries = dict((key, [video, added])
+                                for added, key, video in entries)
+            mkdir_p(os.path.dirname(self.filename))
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.entries, f)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(self.filename + '.tmp', self.filename)
+            self._changed = False
+
+
+def resolve_video_urls(session, func, urls, jobs=1, cache=None):
+    """
+    Look up the video of each page in urls with func(session, url), using
+    up to `jobs` threads and skipping the pages found in the cache.  Return
+    a dict mapping the urls to the videos, without the pages whose video
+    could not be found.
+    """
+    videos = {}
+    missing = []
+    for url in sorted(set(urls)):
+        video = cache.get(url) if cache else None
+        if video is not None:
+            videos[url] = video
+        else:
+            missing.append(url)
+
+    def lookup(url):
+        try:
+            videos[url] = func(session, url)
+        except TypeError:
+            logging.warn('Could not get resource: %s', url)
+            return
+        if cache and videos[url] is not None:
+            cache.put(url, videos[url])
+
+    run_in_threads(lookup, missing, jobs)
+    return videos
+
+
+def parse_syllabus(session, page, reverse=False, intact_fnames=False,
+                   jobs=VIDEO_LOOKUP_JOBS, video_cache=None, failed=None):
     """
     Parses a Coursera course listing/syllabus page.  Each section is a week
     of classes.
+
+    The videos of preview lecture pages and the hidden videos are looked up
+    after walking the page, with up to `jobs` concurrent requests, unless
+    they are found in video_cache.  If failed is a list, the urls of the
+    pages whose video could not be looked up are appended to it.
     """
 
     sections = []
-    soup = BeautifulSoup(page)
+    soup = BeautifulSoup(page, only_class='course-item-list')
+    # (lecture, vtag) of all lectures, in order
+    all_lectures = []
 
     # traverse sections
     for stag in soup.findAll(attrs={'class':
@@ -234,44 +454,71 @@ def parse_syllabus(session, page, reverse=False, intact_fnames=False):
                 # Special case: find preview URLs
                 lecture_page = transform_preview_url(href)
                 if lecture_page:
-                    try:
-                        href = get_video(session, lecture_page)
-                        lecture['mp4'] = lecture.get('mp4', [])
-                        lecture['mp4'].append((fix_url(href), ''))
-                    except TypeError:
-                        logging.warn(
-                            'Could not get resource: %s', lecture_page)
-
-            # Special case: we possibly have hidden video links---thanks to
-            # the University of Washington for that.
-            if 'mp4' not in lecture:
-                for a in vtag.findAll('a'):
-                    if a.get('data-modal-iframe'):
-                        href = grab_hidden_video_url(
-                            session, a['data-modal-iframe'])
-                        href = fix_url(href)
-                        fmt = 'mp4'
-                        logging.debug('    %s %s', fmt, href)
-                        if href is not None:
-                            lecture[fmt] = lecture.get(fmt, [])
-                            lecture[fmt].append((href, ''))
-
-            for fmt in lecture:
-                count = len(lecture[fmt])
-                for i, r in enumerate(lecture[fmt]):
-                    if (count == i + 1):
-                        # for backward compatibility, we do not add the title
-                        # to the filename (format_combine_number_resource and
-                        # format_resource)
-                        lecture[fmt][i] = (r[0], '')
-                    else:
-                        # make sure the title is unique
-                        lecture[fmt][i] = (r[0], '{0:d}_{1}'.format(i, r[1]))
+                    lecture['mp4'] = lecture.get('mp4', [])
+                    lecture['mp4'].append(PendingVideo(lecture_page))
 
             lectures.append((vname, lecture))
+            all_lectures.append((lecture, vtag))
 
         sections.append((section_name, lectures))
 
+    # look up the videos of the preview pages
+    preview_urls = [video.url for resources, vtag in all_lectures
+                    for video in resources.get('mp4', [])
+                    if isinstance(video, PendingVideo)]
+    preview_videos = resolve_video_urls(
+        session, get_video, preview_urls, jobs, video_cache)
+    for lecture, vtag in all_lectures:
+        if 'mp4' not in lecture:
+            continue
+        videos = []
+        for video in lecture['mp4']:
+            if not isinstance(video, PendingVideo):
+                videos.append(video)
+            elif video.url in preview_videos:
+                videos.append((fix_url(preview_videos[video.url]), ''))
+        if videos:
+            lecture['mp4'] = videos
+        else:
+            del lecture['mp4']
+
+    # Special case: we possibly have hidden video links---thanks to
+    # the University of Washington for that.
+    hidden = [(lecture, [a['data-modal-iframe'] for a in vtag.findAll('a')
+                         if a.get('data-modal-iframe')])
+              for lecture, vtag in all_lectures if 'mp4' not in lecture]
+    hidden_urls = [url for lecture, urls in hidden for url in urls]
+    hidden_videos = resolve_video_urls(
+        session, grab_hidden_video_url, hidden_urls, jobs, video_cache)
+    if video_cache:
+        video_cache.save()
+    if failed is not None:
+        failed.extend(url for url in preview_urls
+                      if preview_videos.get(url) is None)
+        failed.extend(url for url in hidden_urls
+                      if hidden_videos.get(url) is None)
+    for lecture, urls in hidden:
+        for url in urls:
+            href = fix_url(hidden_videos.get(url))
+            fmt = 'mp4'
+            logging.debug('    %s %s', fmt, href)
+            if href is not None:
+                lecture[fmt] = lecture.get(fmt, [])
+                lecture[fmt].append((href, ''))
+
+    for lecture, vtag in all_lectures:
+        for fmt in lecture:
+            count = len(lecture[fmt])
+            for i, r in enumerate(lecture[fmt]):
+                if (count == i + 1):
+                    # for backward compatibility, we do not add the title
+                    # to the filename (format_combine_number_resource and
+                    # format_resource)
+                    lecture[fmt][i] = (r[0], '')
+                else:
+                    # make sure the title is unique
+                    lecture[fmt][i] = (r[0], '{0:d}_{1}'.format(i, r[1]))
+
     logging.info('Found %d sections and %d lectures on this page',
                  len(sections), sum(len(s[1]) for s in sections))
 
@@ -285,6 +532,61 @@ def parse_syllabus(session, page, reverse=False, intact_fnames=False):
     return sections
 
 
+def get_syllabus_cache_path(class_name):
+    return os.path.join(PATH_CACHE, 'syllabus', class_name + '.json')
+
+
+def parse_syllabus_cached(session, page, cache_fn, reverse=False,
+                          intact_fnames=False, video_cache=None,
+                          ttl=VIDEO_CACHE_TTL):
+    """
+    Like parse_syllabus, but reuse the sections parsed from the same page
+    (with the same options) by an earlier run, for up to `ttl` seconds so
+    that the videos do not go stale.  The sections are kept in cache_fn,
+    unless some video could not be looked up, so that the next run tries
+    again.
+    """
+    page_hash = hashlib.sha1(json.dumps(
+        [page, bool(reverse), bool(intact_fnames)]).encode('utf-8')).hexdigest()
+
+    if os.path.exists(cache_fn):
+        try:
+            with open(cache_fn) as f:
+                cached = json.load(f)
+            if (cached['hash'] == page_hash and
+                    cached['saved'] + ttl >= time.time()):
+                logging.info('Using the sections parsed from the same page '
+                             'before')
+                return [
+                    (section_name,
+                     [(vname,
+                       dict((fmt, [tuple(resource) for resource in resources])
+                            for fmt, resources in iteritems(lecture)))
+                      for vname, lecture in lectures])
+                    for section_name, lectures in cached['sections']]
+        except (ValueError, KeyError, TypeError):
+            logging.debug('Ignoring bad syllabus cache %s', cache_fn)
+
+    failed = []
+    sections = parse_syllabus(session, page, reverse, intact_fnames,
+                              video_cache=video_cache, failed=failed)
+
+    if failed:
+        logging.debug('Not caching the sections, %d videos could not be '
+                      'looked up', len(set(failed)))
+    elif sections:
+        mkdir_p(os.path.dirname(cache_fn))
+        with open(cache_fn + '.tmp', 'w') as f:
+            json.dump({'hash': page_hash,
+                       'saved': time.time(),
+                       'sections': sections}, f, separators=(',', ':'))
+        if os.path.exists(cache_fn):
+            os.remove(cache_fn)
+        os.rename(cache_fn + '.tmp', cache_fn)
+
+    return sections
+
+
 def download_about(session, class_name, path='', overwrite=False):
     """
     Download the 'about' metadata which is in JSON format and pretty-print it.
@@ -325,10 +627,20 @@ def download_lectures(downloader,
                       combined_section_lectures_nums=False,
                       hooks=None,
                       playlist=False,
-                      intact_fnames=False
+                      intact_fnames=False,
+                      jobs=1,
+                      manifest=None,
+                      conditional=False
                       ):
     """
     Downloads lecture resources described by sections.
+
+    The full list of resources to download is built first and is then
+    handed to the downloader, which fetches up to `jobs` of them at a time.
+    If a manifest is given, files it knows to be complete are skipped
+    without touching the disk and every download is recorded in it.  With
+    `conditional`, those files are instead re-requested with the validators
+    stored in the manifest and only downloaded again if they changed.
     Returns True if the class appears completed.
     """
     last_update = -1
@@ -349,6 +661,11 @@ def download_lectures(downloader,
             title = '_' + title
         return '%02d_%02d_%s%s.%s' % (secnum, lecnum, lecname, title, fmt)
 
+    # (url, filename) pairs still to be downloaded
+    plan = []
+    # section directories which were not filtered out
+    section_dirs = []
+
     for (secnum, (section, lectures)) in enumerate(sections):
         if section_filter and not re.search(section_filter, section):
             logging.debug('Skipping b/c of sf: %s %s', section_filter,
@@ -356,6 +673,7 @@ def download_lectures(downloader,
             continue
         sec = os.path.join(path, class_name, format_section(secnum + 1,
                                                             section))
+        section_dirs.append(sec)
         for (lecnum, (lecname, lecture)) in enumerate(lectures):
             if lecture_filter and not re.search(lecture_filter,
                                                 lecname):
@@ -391,40 +709,73 @@ def download_lectures(downloader,
                     lecfn = os.path.join(
                         sec, format_resource(lecnum + 1, lecname, title, fmt))
 
-                if overwrite or not os.path.exists(lecfn):
+                entry = manifest.get(lecfn) if manifest else None
+                validators = None
+                if entry and (entry.get('etag') or entry.get('last_modified')):
+                    validators = dict(etag=entry.get('etag'),
+                                      last_modified=entry.get('last_modified'))
+                if (conditional and validators and not skip_download and
+                        manifest.is_done(lecfn)):
+                    logging.info('Checking for changes: %s', lecfn)
+                    plan.append((url, lecfn, validators))
+                    last_update = max(last_update, entry['mtime'])
+                elif not overwrite and manifest and manifest.is_done(lecfn):
+                    logging.info('%s already downloaded', lecfn)
+                    last_update = max(last_update, entry['mtime'])
+                elif (overwrite or not os.path.exists(lecfn) or
+                      (entry and entry['status'] != 'complete') or
+                      # partially downloaded by aria2
+                      os.path.exists(lecfn + '.aria2')):
                     if not skip_download:
-                        logging.info('Downloading: %s', lecfn)
-                        downloader.download(url, lecfn)
+                        plan.append((url, lecfn))
+                        if manifest:
+                            manifest.update(lecfn, url=url,
+                                            status='downloading')
                     else:
                         open(lecfn, 'w').close()  # touch
                     last_update = time.time()
                 else:
                     logging.info('%s already downloaded', lecfn)
+                    if manifest:
+                        manifest.record_existing(url, lecfn)
                     # if this file hasn't been modified in a long time,
                     # record that time
                     last_update = max(last_update, os.path.getmtime(lecfn))
 
+    # files that were actually (re)downloaded
+    updated = []
+
+    def record(url, filename, result):
+        if manifest:
+            manifest.record_download(url, filename, result)
+        if not getattr(result, 'not_modified', False):
+            updated.append(filename)
+
+    if plan:
+        downloader.download_many(plan, jobs, record)
+        if updated:
+            last_update = time.time()
+
+    for sec in section_dirs:
         # After fetching resources, create a playlist in M3U format with the
         # videos downloaded.
+        # The working directory is not changed, as other classes may be
+        # downloaded at the same time.
         if playlist:
-            path_to_return = os.getcwd()
-
             for (_path, subdirs, files) in os.walk(sec):
-                os.chdir(_path)
-                globbed_videos = glob.glob("*.mp4")
-                m3u_name = os.path.split(_path)[1] + ".m3u"
+                globbed_videos = glob.glob(os.path.join(_path, "*.mp4"))
+                m3u_name = os.path.join(_path,
+                                        os.path.split(_path)[1] + ".m3u")
 
                 if len(globbed_videos):
                     with open(m3u_name, "w") as m3u:
                         for video in globbed_videos:
-                            m3u.write(video + "\n")
-                    os.chdir(path_to_return)
+                            m3u.write(os.path.basename(video) + "\n")
 
         if hooks:
             for hook in hooks:
                 logging.info('Running hook %s for section %s.', hook, sec)
-                os.chdir(sec)
-                subprocess.call(hook)
+                subprocess.call(hook, cwd=sec, shell=True)
 
     # if we haven't updated any files in 1 month, we're probably
     # done with this course
@@ -441,6 +792,197 @@ class EndOfForumError(Exception): pass
 class NotJSONError(Exception): pass
 
 
+def forum_thread_exists(session, class_name, thread_id):
+    """
+    Check whether the given forum thread id is before the end of the forum,
+    reading only the beginning of the response.  Private and deleted
+    threads count as existing.
+    """
+    url = THREAD_URL.format(class_name=class_name, thread_id=thread_id)
+    r = session.get(url, stream=True)
+    try:
+        start = next(r.iter_content(512), b'')
+    finally:
+        r.close()
+    return b'Unexpected API error' not in start
+
+
+def find_last_thread_id(session, class_name, from_thread_id=1, throttle=None):
+    """
+    Find the id of the last thread of the forum with few requests: probe
+    ids at exponentially growing distances from from_thread_id until one
+    is past the end of the forum, then binary search the boundary.
+
+    Returns from_thread_id - 1 if there are no threads from there on, and
+    None if a probe failed.
+    """
+    probes = [0]
+
+    def exists(thread_id):
+        if throttle:
+            throttle()
+        probes[0] += 1
+        return forum_thread_exists(session, class_name, thread_id)
+
+    try:
+        if not exists(from_thread_id):
+            return from_thread_id - 1
+
+        lo = from_thread_id
+        step = 1
+        while exists(from_thread_id + step):
+            lo = from_thread_id + step
+            step *= 2
+        hi = from_thread_id + step
+
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if exists(mid):
+                lo = mid
+            else:
+                hi = mid
+    except requests.exceptions.RequestException as e:
+        logging.warn('Could not find the last forum thread: %s', e)
+        return None
+
+    logging.info('Found last forum thread %d with %d requests', lo,
+                 probes[0])
+    return lo
+
+
+class ForumProgress(object):
+    """
+    Report progress and estimated time left while downloading the threads
+    of a forum whose thread id range is known.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def thread_done(self):
+        with self._lock:
+            self.done += 1
+            elapsed = time.time() - self._start
+            eta = elapsed / self.done * max(self.total - self.done, 0)
+            logging.info('Forum threads: %d/%d, ETA %s', self.done,
+                         self.total, datetime.timedelta(seconds=int(eta)))
+
+
+def forum_thread_state(thread):
+    """
+    Return what we need to know about a downloaded thread to notice new
+    activity in it.
+    """
+    return {
+        'num_pages': thread.get('num_pages', 1),
+        'num_posts': thread.get('num_posts'),
+        'last_updated_time': thread.get('last_updated_time'),
+    }
+
+
+def parse_forum_thread_state(data):
+    """
+    Return the state of the thread whose first page is data, or None if
+    there is no page or it is not a thread.
+    """
+    try:
+        return forum_thread_state(json.loads(data))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def read_forum_thread_state(thread_fn):
+    """
+    Return the state of the thread whose first page is in thread_fn, or
+    None if the file is missing or is not a thread.
+    """
+    try:
+        with open(thread_fn) as f:
+            return parse_forum_thread_state(f.read())
+    except IOError:
+        return None
+
+
+def get_forum_index_path(json_dir):
+    return os.path.join(json_dir, FORUM_INDEX_FN)
+
+
+def update_forum_index(index, json_dir, thread_ids, store=None):
+    """
+    Read the state of the given threads into the index.
+    """
+    for thread_id in thread_ids:
+        if store is not None:
+            state = parse_forum_thread_state(store.get_page(thread_id, 1))
+        else:
+            state = read_forum_thread_state(
+                os.path.join(json_dir, '%d-1.json' % thread_id))
+        if state is None:
+            continue
+        index['threads'][str(thread_id)] = state
+        index['high_water_mark'] = max(index['high_water_mark'], thread_id)
+
+
+def load_forum_index(json_dir, store=None):
+    """
+    Load the index of the downloaded threads of a forum, building it from
+    the downloaded first pages (in the page store, if given) if there is
+    none yet.
+    """
+    index_fn = get_forum_index_path(json_dir)
+    if os.path.exists(index_fn):
+        try:
+            with open(index_fn) as f:
+                return json.load(f)
+        except ValueError:
+            logging.warn('Rebuilding broken forum index %s', index_fn)
+
+    index = {'high_water_mark': 0, 'threads': {}}
+    thread_ids = []
+    if store is not None:
+        thread_ids = sorted(store.thread_pages())
+    else:
+        for thread_fn in glob.glob(os.path.join(json_dir, '*-1.json')):
+            try:
+                thread_ids.append(
+                    int(os.path.basename(thread_fn).split('-')[0]))
+            except ValueError:
+                continue
+    update_forum_index(index, json_dir, thread_ids, store)
+    return index
+
+
+def save_forum_index(json_dir, index):
+    index_fn = get_forum_index_path(json_dir)
+    with open(index_fn + '.tmp', 'w') as f:
+        json.dump(index, f)
+    if os.path.exists(index_fn):
+        os.remove(index_fn)
+    os.rename(index_fn + '.tmp', index_fn)
+
+
+def remove_end_of_forum_markers(json_dir, from_thread_id, manifest=None):
+    """
+    Remove the 'Unexpected API error' responses saved at the end of the
+    forum by earlier runs, so that threads created since then are fetched.
+    """
+    thread_id = from_thread_id
+    while True:
+        thread_fn = os.path.join(json_dir, '%d-1.json' % thread_id)
+        if not os.path.exists(thread_fn):
+            break
+        with open(thread_fn) as f:
+            is_marker = 'Unexpected API error' in f.read()
+        if is_marker:
+            os.remove(thread_fn)
+            if manifest:
+                manifest.update(thread_fn, status='stale')
+        thread_id += 1
+
+
 def download_forum(downloader,
                    class_name,
                    path='',
@@ -448,16 +990,187 @@ def download_forum(downloader,
                    from_thread_id=None,
                    wait_time=3,
                    wait_time_fluctuation=3,
+                   manifest=None,
+                   jobs=1,
+                   rate=None,
+                   burst=1,
+                   probe=False,
+                   incremental=False,
+                   recheck_days=None,
+                   store_pages=False,
                    ):
     """
     Download all forum threads.
+
+    With `jobs` > 1, several threads are downloaded at the same time.  All
+    requests then share a token bucket allowing `rate` requests per second
+    (with bursts of up to `burst` requests), which defaults to the average
+    rate given by the wait times.
+
+    With `probe`, the id of the last thread is looked up first, so that
+    progress can be reported and downloading stops right there.
+
+    With `incremental`, the threads recorded in the forum index are checked
+    for new activity (only those active in the last `recheck_days` days, if
+    given) and re-downloaded if needed, and the crawl continues after the
+    highest known thread id.
+
+    With `store_pages`, the downloaded pages are kept in a single database
+    in the json dir (see forum.PageStore) instead of one file per page.
     """
     json_dir = get_json_dir(class_name, path, verbose_dirs)
     if not os.path.isdir(json_dir):
         os.makedirs(json_dir)
+
+    store = None
+    if store_pages:
+        store = PageStore(get_page_store_path(json_dir))
+    try:
+        return _download_forum(downloader, class_name, json_dir,
+                               from_thread_id, wait_time,
+                               wait_time_fluctuation, manifest, jobs, rate,
+                               burst, probe, incremental, recheck_days, store)
+    finally:
+        if store is not None:
+            store.close()
+
+
+def _download_forum(downloader, class_name, json_dir, from_thread_id,
+                    wait_time, wait_time_fluctuation, manifest, jobs, rate,
+                    burst, probe, incremental, recheck_days, store):
+    rate_limiter = None
+    if not rate and jobs > 1 and wait_time:
+        rate = 1.0 / (wait_time + (wait_time_fluctuation or 0) / 2.0)
+    if rate:
+        rate_limiter = TokenBucket(rate, burst)
+        logging.debug('Limiting forum requests to %.2f/s', rate)
+
     thread_id = from_thread_id or 1
+
+    index = None
+    if incremental:
+        index = load_forum_index(json_dir, store)
+        if not refresh_forum_threads(
+                downloader, class_name, json_dir, index, jobs,
+                wait_time, wait_time_fluctuation, rate_limiter, manifest,
+                recheck_days, store):
+            save_forum_index(json_dir, index)
+            return False
+        thread_id = max(thread_id, index['high_water_mark'] + 1)
+        remove_end_of_forum_markers(json_dir, thread_id, manifest)
+
+    last_thread_id = None
+    progress = None
+    if probe:
+        if rate_limiter:
+            throttle = rate_limiter.acquire
+        else:
+            throttle = lambda: time.sleep(wait_time or 0)
+        last_thread_id = find_last_thread_id(
+            downloader.session, class_name, thread_id, throttle)
+        if last_thread_id is None:
+            logging.info('Downloading forum threads one by one')
+            jobs = 1
+        else:
+            progress = ForumProgress(max(last_thread_id - thread_id + 1, 0))
+
+    if jobs > 1:
+        complete = download_forum_parallel(
+            downloader, class_name, json_dir, thread_id, jobs,
+            rate_limiter, manifest, last_thread_id, progress, store)
+    else:
+        complete = download_forum_sequential(
+            downloader, class_name, json_dir, thread_id, wait_time,
+            wait_time_fluctuation, rate_limiter, manifest, last_thread_id,
+            progress, store)
+
+    if index is not None:
+        def is_downloaded(thread_id):
+            if store is not None:
+                return store.has_page(thread_id, 1)
+            return os.path.exists(
+                os.path.join(json_dir, '%d-1.json' % thread_id))
+
+        new_thread_ids = itertools.takewhile(is_downloaded,
+                                             itertools.count(thread_id))
+        update_forum_index(index, json_dir, new_thread_ids, store)
+        save_forum_index(json_dir, index)
+
+    return complete
+
+
+def refresh_forum_threads(downloader,
+                          class_name,
+                          json_dir,
+                          index,
+                          jobs=1,
+                          wait_time=3,
+                          wait_time_fluctuation=3,
+                          rate_limiter=None,
+                          manifest=None,
+                          recheck_days=None,
+                          store=None):
+    """
+    Check the threads of the forum index for new activity, re-downloading
+    the ones that had some.  Returns False if there was an error.
+    """
+    threads = index['threads']
+    thread_ids = sorted(int(thread_id) for thread_id in threads)
+    if recheck_days is not None:
+        since = time.time() - recheck_days * 24 * 3600
+        thread_ids = [
+            thread_id for thread_id in thread_ids
+            if (threads[str(thread_id)].get('last_updated_time') or 0) >= since]
+    logging.info('Checking %d forum threads for new activity',
+                 len(thread_ids))
+
+    def refresh(thread_id):
+        download_thread(
+            downloader,
+            class_name,
+            thread_id,
+            json_dir,
+            wait_time=wait_time,
+            wait_time_fluctuation=wait_time_fluctuation,
+            manifest=manifest,
+            rate_limiter=rate_limiter,
+            refresh=threads[str(thread_id)],
+            store=store,
+        )
+
+    try:
+        run_in_threads(refresh, thread_ids, jobs)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        logging.error('Error refreshing forum: %r', e)
+        return False
+    finally:
+        update_forum_index(index, json_dir, thread_ids, store)
+
+    return True
+
+
+def download_forum_sequential(downloader,
+                              class_name,
+                              json_dir,
+                              thread_id=1,
+                              wait_time=3,
+                              wait_time_fluctuation=3,
+                              rate_limiter=None,
+                              manifest=None,
+                              last_thread_id=None,
+                              progress=None,
+                              store=None):
+    """
+    Download forum threads one after the other, starting at thread_id,
+    until the end of the forum or, if known, the last thread id.
+    """
     complete = False
     while True:
+        if last_thread_id is not None and thread_id > last_thread_id:
+            complete = True
+            break
         try:
             download_thread(
                 downloader,
@@ -466,6 +1179,9 @@ def download_forum(downloader,
                 json_dir,
                 wait_time=wait_time,
                 wait_time_fluctuation=wait_time_fluctuation,
+                manifest=manifest,
+                rate_limiter=rate_limiter,
+                store=store,
             )
         except EndOfForumError:
             complete = True
@@ -480,19 +1196,93 @@ def download_forum(downloader,
             break
         else:
             thread_id += 1
+        if progress:
+            progress.thread_done()
 
     return complete
 
 
+def download_forum_parallel(downloader,
+                            class_name,
+                            json_dir,
+                            from_thread_id=None,
+                            jobs=2,
+                            rate_limiter=None,
+                            manifest=None,
+                            last_thread_id=None,
+                            progress=None,
+                            store=None):
+    """
+    Download forum threads with several worker threads, handing out thread
+    ids in order until one of them hits the end of the forum or, if known,
+    the last thread id is reached.
+    """
+    # the lowest thread id known to be past the end of the forum
+    end = []
+    if last_thread_id is not None:
+        end.append(last_thread_id + 1)
+
+    def thread_ids():
+        thread_id = from_thread_id or 1
+        while not end or thread_id < min(end):
+            yield thread_id
+            thread_id += 1
+
+    def fetch(thread_id):
+        try:
+            download_thread(
+                downloader,
+                class_name,
+                thread_id,
+                json_dir,
+                wait_time=None,
+                manifest=manifest,
+                rate_limiter=rate_limiter,
+                store=store,
+            )
+        except EndOfForumError:
+            end.append(thread_id)
+        except NotJSONError:
+            # skip this thread
+            pass
+        if progress:
+            progress.thread_done()
+
+    try:
+        run_in_threads(fetch, thread_ids(), jobs)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        logging.error('Error downloading forum: %r', e)
+        return False
+
+    return bool(end)
+
+
 def download_thread(downloader,
                     class_name,
                     thread_id,
                     base_dir,
                     max_pages=10,
                     wait_time=3,
-                    wait_time_fluctuation=3):
+                    wait_time_fluctuation=3,
+                    manifest=None,
+                    rate_limiter=None,
+                    refresh=None,
+                    store=None):
+    """
+    Download the pages of a forum thread into base_dir, skipping pages that
+    were already downloaded.  If a page store is given, the pages are moved
+    into it once downloaded.
+
+    If refresh is given (the state of the thread when it was last
+    downloaded, see forum_thread_state), the first page is downloaded again
+    and the thread is only downloaded anew if it had new activity.
+    """
     def sleep():
-        if wait_time:
+        if rate_limiter:
+            rate_limiter.acquire()
+        elif wait_time:
             secs = wait_time
             if wait_time_fluctuation:
                 secs += random.randint(0, wait_time_fluctuation)
@@ -502,14 +1292,6 @@ def download_thread(downloader,
     def format_json_fn(thread_id, page):
         return '%d-%d.json' % (thread_id, page)
 
-    def ungzip(thread_fn):
-        if not os.path.isfile(thread_fn):
-            return
-        with gzip.open(thread_fn, 'rb') as f:
-            response = f.read()
-        with open(thread_fn, 'w') as f:
-            f.write(response)
-
     def check_end_of_forum(thread_fn):
         if not os.path.isfile(thread_fn):
             return
@@ -534,36 +1316,85 @@ def download_thread(downloader,
                 break
         return None if not placeholder else placeholder['id']
 
-    def download(url, dest, should_ungzip):
+    def download(url, dest):
         sleep()
-        downloader.download(url, dest)
-        if should_ungzip:
-            ungzip(dest)
+        result = downloader.download(url, dest)
+        if manifest:
+            manifest.record_download(url, dest, result)
+
+    def is_downloaded(url, thread_fn, page):
+        if store is not None:
+            if store.has_page(thread_id, page):
+                return True
+            if not os.path.isfile(thread_fn):
+                return False
+            # downloaded before the store was used; the end of the forum
+            # is fetched again, as it is never stored
+            try:
+                check_end_of_forum(thread_fn)
+            except (EndOfForumError, NotJSONError):
+                return False
+            store.import_page(thread_id, page, thread_fn)
+            return True
+        if not manifest:
+            return os.path.exists(thread_fn)
+        if manifest.get(thread_fn):
+            return manifest.is_done(thread_fn)
+        if os.path.exists(thread_fn):
+            manifest.record_existing(url, thread_fn)
+            return True
+        return False
 
     thread_url = THREAD_URL.format(
         class_name=class_name,
         thread_id=thread_id)
     page = 1
     next_post_id = None
-    should_ungzip = is_native_downloader(downloader)
     while page <= max_pages:
         thread_fn = os.path.join(base_dir, format_json_fn(thread_id, page))
         query = ''
         if next_post_id:
             query = '?post_id={0}&position=after'.format(next_post_id)
-        if not os.path.exists(thread_fn):
-            download(thread_url + query, thread_fn, should_ungzip)
+        if refresh is not None and page == 1:
+            # keep what we have until we know that it changed
+            new_fn = thread_fn + '.new'
+            sleep()
+            result = downloader.download(thread_url, new_fn)
+            state = read_forum_thread_state(new_fn) if result else None
+            if state is None or state == refresh:
+                if not result:
+                    logging.error('Could not refresh thread %d', thread_id)
+                else:
+                    logging.info('No new activity in thread %d', thread_id)
+                if os.path.exists(new_fn):
+                    os.remove(new_fn)
+                return
+            logging.info('New activity in thread %d', thread_id)
+            if os.path.exists(thread_fn):
+                os.remove(thread_fn)
+            os.rename(new_fn, thread_fn)
+            if manifest:
+                manifest.update(thread_fn, url=thread_url, status='complete',
+                                size=os.path.getsize(thread_fn))
+        elif refresh is not None or not is_downloaded(thread_url + query,
+                                                      thread_fn, page):
+            download(thread_url + query, thread_fn)
         logging.info('Downloaded %s', thread_fn)
         if page == 1:
             try:
                 check_end_of_forum(thread_fn)
             except NotJSONError:
                 # retry once in case something went utterly wrong
-                download(thread_url + query, thread_fn, should_ungzip)
+                download(thread_url + query, thread_fn)
                 check_end_of_forum(thread_fn)
+        if store is not None and os.path.isfile(thread_fn):
+            store.import_page(thread_id, page, thread_fn)
         try:
-            with open(thread_fn) as f:
-                thread = json.load(f)
+            if store is not None:
+                thread = json.loads(store.get_page(thread_id, page))
+            else:
+                with open(thread_fn) as f:
+                    thread = json.load(f)
         except:
             break
         max_pages = min(max_pages, thread.get('num_pages', 1))
@@ -581,6 +1412,23 @@ def total_seconds(td):
            (td.seconds + td.days * 24 * 3600) * 10**6) // 10**6
 
 
+def sphinx_jobs_type(value):
+    """
+    Parse the value of --sphinx-jobs, a positive number of processes or
+    'auto' for one per CPU.
+    """
+    if value == 'auto':
+        return multiprocessing.cpu_count()
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(
+            'expected a positive number or "auto", got %r' % value)
+    return jobs
+
+
 def parseArgs():
     """
     Parse the arguments/options passed to the program on the command line.
@@ -640,6 +1488,25 @@ def parseArgs():
                         action='store_true',
                         default=False,
                         help='generate forum viewer. (Default: False)')
+    parser.add_argument('--render-jobs',
+                        dest='render_jobs',
+                        type=int,
+                        default=1,
+                        help='number of processes rendering forum threads for'
+                             ' the forum viewer (default: 1)')
+    parser.add_argument('--forum-viewer-backend',
+                        dest='forum_viewer_backend',
+                        choices=['sphinx', 'html'],
+                        default='sphinx',
+                        help='how the forum viewer is built: with'
+                             ' sphinx-build, or rendered directly to html'
+                             ' (faster, but without search). (Default: sphinx)')
+    parser.add_argument('--sphinx-jobs',
+                        dest='sphinx_jobs',
+                        type=sphinx_jobs_type,
+                        default=None,
+                        help='number of parallel sphinx-build processes for'
+                             ' the forum viewer, or "auto" (default: none)')
     parser.add_argument('--from-thread-id',
                         dest='from_thread_id',
                         type=int,
@@ -766,6 +1633,94 @@ def parseArgs():
                         type=int,
                         default=3,
                         help='max of random seconds to add to the wait time')
+    parser.add_argument('-j',
+                        '--jobs',
+                        dest='jobs',
+                        type=int,
+                        default=1,
+                        help='number of lecture resources to download in'
+                             ' parallel (default: 1)')
+    parser.add_argument('--class-jobs',
+                        dest='class_jobs',
+                        type=int,
+                        default=1,
+                        help='number of classes to download in parallel;'
+                             ' the classes share the limit of --jobs'
+                             ' downloads at a time (default: 1)')
+    parser.add_argument('--manifest',
+                        dest='manifest',
+                        action='store_true',
+                        default=False,
+                        help='keep a per-class record of downloaded files, so'
+                             ' that re-runs only look at new or incomplete'
+                             ' files (default: False)')
+    parser.add_argument('--conditional',
+                        dest='conditional',
+                        action='store_true',
+                        default=False,
+                        help='check downloaded files and the syllabus for'
+                             ' changes with conditional requests and download'
+                             ' them again if they changed (implies'
+                             ' --manifest)')
+    parser.add_argument('--resume',
+                        dest='resume',
+                        action='store_true',
+                        default=False,
+                        help='keep partially downloaded files and resume them'
+                             ' (for native downloader and aria2)')
+    parser.add_argument('--segments',
+                        dest='segments',
+                        type=int,
+                        default=1,
+                        help='split large files into this many parts that are'
+                             ' downloaded in parallel (for native downloader)')
+    parser.add_argument('--forum-jobs',
+                        dest='forum_jobs',
+                        type=int,
+                        default=1,
+                        help='number of forum threads to download in parallel'
+                             ' (default: 1)')
+    parser.add_argument('--forum-rate',
+                        dest='forum_rate',
+                        type=float,
+                        default=None,
+                        help='max forum requests per second, shared by all'
+                             ' forum jobs; replaces the wait time (default:'
+                             ' derived from the wait time)')
+    parser.add_argument('--forum-burst',
+                        dest='forum_burst',
+                        type=int,
+                        default=1,
+                        help='number of forum requests that may be sent at'
+                             ' once before --forum-rate applies (default: 1)')
+    parser.add_argument('--forum-probe',
+                        dest='forum_probe',
+                        action='store_true',
+                        default=False,
+                        help='look up the last forum thread id before'
+                             ' downloading, to report progress (default:'
+                             ' False)')
+    parser.add_argument('--forum-incremental',
+                        dest='forum_incremental',
+                        action='store_true',
+                        default=False,
+                        help='only re-download forum threads with new'
+                             ' activity and threads created since the last'
+                             ' run (default: False)')
+    parser.add_argument('--forum-recheck-days',
+                        dest='forum_recheck_days',
+                        type=int,
+                        default=None,
+                        help='with --forum-incremental, only check threads'
+                             ' active in the last N days for new activity'
+                             ' (default: check all threads)')
+    parser.add_argument('--forum-store-pages',
+                        dest='forum_store_pages',
+                        action='store_true',
+                        default=False,
+                        help='keep the downloaded forum pages in a single'
+                             ' compressed database instead of one file per'
+                             ' page. (Default: False)')
     parser.add_argument('--retry-count',
                         dest='retry_count',
                         type=int,
@@ -819,6 +1774,12 @@ def parseArgs():
                         action='store_true',
                         default=False,
                         help='generate M3U playlists for course weeks')
+    parser.add_argument('--html-parser',
+                        dest='html_parser',
+                        choices=['lxml', 'html.parser', 'html5lib'],
+                        default=None,
+                        help='parser used for the course pages (default: the'
+                             ' fastest one installed)')
     parser.add_argument('--clear-cache',
                         dest='clear_cache',
                         action='store_true',
@@ -855,6 +1816,13 @@ def parseArgs():
     # turn list of strings into list
     args.file_formats = args.file_formats.split()
 
+    if args.html_parser:
+        try:
+            set_html_parser(args.html_parser)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
+
     for bin in ['wget_bin', 'curl_bin', 'aria2_bin', 'axel_bin']:
         if getattr(args, bin):
             logging.error('The --%s option is deprecated, please use --%s',
@@ -895,27 +1863,40 @@ def get_session(args, class_name):
     return session
 
 
-def download_class(args, class_name):
+def download_class(args, class_name, download_limit=None, abort=None):
     """
     Download all requested resources from the class given in class_name.
     Returns True if the class appears completed.
+
+    download_limit is a semaphore held by every download, and abort the
+    event set on Ctrl-C, both shared by the classes downloaded at the same
+    time.
     """
     if args.about or args.lecture or args.forum:
         session = get_session(args, class_name)
 
     if args.lecture:
         # get the syllabus listing
-        page = get_syllabus(session, class_name, args.local_page, args.preview)
+        page = get_syllabus(session, class_name, args.local_page, args.preview,
+                            args.conditional)
 
         # parse it
-        sections = parse_syllabus(session, page, args.reverse,
-                                  args.intact_fnames)
+        sections = parse_syllabus_cached(
+            session, page, get_syllabus_cache_path(class_name),
+            args.reverse, args.intact_fnames,
+            video_cache=VideoCache(VIDEO_CACHE_FN, class_name))
 
     if args.about:
         download_about(session, class_name, args.path, args.overwrite)
 
     if args.lecture or args.forum:
         downloader = get_downloader(session, class_name, args)
+        downloader.limit = download_limit
+        downloader.abort = abort
+
+    manifest = None
+    if args.manifest or args.conditional:
+        manifest = Manifest(get_manifest_path(class_name, args.path))
 
     # obtain the resources
     completed = True
@@ -928,14 +1909,28 @@ def download_class(args, class_name):
             args.from_thread_id,
             args.wait_time,
             args.wait_time_fluctuation,
+            manifest,
+            args.forum_jobs,
+            args.forum_rate,
+            args.forum_burst,
+            args.forum_probe,
+            args.forum_incremental,
+            args.forum_recheck_days,
+            args.forum_store_pages,
         )
     if args.forum_viewer:
         completed = completed and generate_forum(
             class_name,
             args.path,
             args.verbose_dirs,
+            jobs=args.render_jobs,
+            backend=args.forum_viewer_backend,
+            sphinx_jobs=args.sphinx_jobs,
         )
     if args.lecture:
+        # only the manifest needs the validators of external downloads,
+        # forum pages (downloaded above) never ask for them
+        downloader.fetch_validators = manifest is not None
         completed = completed and download_lectures(
             downloader,
             class_name,
@@ -952,7 +1947,10 @@ def download_class(args, class_name):
             args.combined_section_lectures_nums,
             args.hooks,
             args.playlist,
-            args.intact_fnames)
+            args.intact_fnames,
+            args.jobs,
+            manifest,
+            args.conditional)
 
     return completed
 
@@ -963,17 +1961,23 @@ def main():
     """
 
     args = parseArgs()
-    completed_classes = []
 
     mkdir_p(PATH_CACHE, 0o700)
     if args.clear_cache:
         shutil.rmtree(PATH_CACHE)
 
-    for class_name in args.class_names:
+    download_limit = None
+    if args.class_jobs > 1:
+        download_limit = threading.BoundedSemaphore(max(args.jobs, 1))
+    abort = threading.Event()
+
+    completed = {}
+
+    def download(class_name):
         try:
             logging.info('Downloading class: %s', class_name)
-            if download_class(args, class_name):
-                completed_classes.append(class_name)
+            completed[class_name] = download_class(args, class_name,
+                                                   download_limit, abort)
         except requests.exceptions.HTTPError as e:
             logging.error('HTTPError %s', e)
         except ClassNotFound as cnf:
@@ -981,6 +1985,10 @@ def main():
         except AuthenticationFailed as af:
             logging.error('Could not authenticate: %s', af)
 
+    run_in_threads(download, args.class_names, args.class_jobs, abort)
+
+    completed_classes = [class_name for class_name in args.class_names
+                         if completed.get(class_name)]
     if completed_classes:
         logging.info(
             "Classes which appear completed: " + " ".join(completed_classes))
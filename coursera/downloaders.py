@@ -5,13 +5,62 @@ from __future__ import print_function
 import logging
 import math
 import os
+import re
 import requests
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
 from six import iteritems
 
+from .utils import run_in_threads
+
+
+class DownloadResult(object):
+    """
+    What a downloader learned about a successful download.
+
+    :param size: Size of the complete file as announced by the server.
+    :param etag: ETag header of the response.
+    :param last_modified: Last-Modified header of the response.
+    :param not_modified: True if the file was left alone because the server
+        said it did not change.
+    """
+
+    def __init__(self, size=None, etag=None, last_modified=None,
+                 not_modified=False):
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.not_modified = not_modified
+
+
+def conditional_headers(validators):
+    """
+    Build the headers of a conditional request from a dict with the 'etag'
+    and/or 'last_modified' of a previous response.
+    """
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def not_modified_result(response, validators):
+    """
+    Build the result of a download that was skipped because of a 304 Not
+    Modified response.
+    """
+    return DownloadResult(
+        etag=response.headers.get('etag') or validators.get('etag'),
+        last_modified=(response.headers.get('last-modified') or
+                       validators.get('last_modified')),
+        not_modified=True)
+
 
 class Downloader(object):
     """
@@ -24,23 +73,52 @@ class Downloader(object):
       >>> import downloaders
       >>> d = downloaders.SubclassFromDownloader()
       >>> d.download('http://example.com', 'save/to/this/file')
+
+    If limit is set to a semaphore, every download holds it while it runs,
+    which bounds the number of downloads of all downloaders sharing it.
+    abort is the event that tells downloads running in worker threads that
+    the user interrupted the program (see utils.run_in_threads).
     """
 
-    def _start_download(self, url, filename):
+    limit = None
+    abort = None
+
+    def _check_abort(self):
+        """
+        Raise KeyboardInterrupt in a worker thread if the program was
+        interrupted, so that the download cleans up after itself.
+        """
+        if self.abort is not None and self.abort.is_set():
+            raise KeyboardInterrupt
+
+    def _start_download(self, url, filename, validators=None):
         """
         Actual method to download the given url to the given file.
+        Returns a DownloadResult on success and False otherwise.
         This method should be implemented by the subclass.
         """
         raise NotImplementedError("Subclasses should implement this")
 
-    def download(self, url, filename):
+    def download(self, url, filename, validators=None):
         """
         Download the given url to the given file. When the download
         is aborted by the user, the partially downloaded file is also removed.
+
+        If validators (the 'etag' and/or 'last_modified' of the existing
+        file) are given, the file is only downloaded if it changed on the
+        server.
         """
 
+        if self.limit is not None:
+            with self.limit:
+                return self._download(url, filename, validators)
+        return self._download(url, filename, validators)
+
+    def _download(self, url, filename, validators=None):
         try:
-            self._start_download(url, filename)
+            if validators:
+                return self._start_download(url, filename, validators)
+            return self._start_download(url, filename)
         except KeyboardInterrupt as e:
             logging.info(
                 'Keyboard Interrupt -- Removing partial file: %s', filename)
@@ -50,6 +128,38 @@ class Downloader(object):
                 pass
             raise e
 
+    def download_many(self, items, jobs=1, callback=None):
+        """
+        Download every (url, filename[, validators]) tuple in items, running
+        up to `jobs` downloads at the same time in worker threads.  If given,
+        callback is called with the url, the filename and the result of each
+        download.
+        """
+
+        if self.abort is None:
+            self.abort = threading.Event()
+        running = set()
+
+        def download(item):
+            url, filename = item[:2]
+            running.add(filename)
+            logging.info('Downloading: %s', filename)
+            result = self.download(*item)
+            running.discard(filename)
+            if callback:
+                callback(url, filename, result)
+
+        try:
+            run_in_threads(download, items, jobs, self.abort)
+        finally:
+            if self.abort.is_set():
+                # the workers have been joined, anything left is partial
+                for filename in running:
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
+
 
 class ExternalDownloader(Downloader):
     """
@@ -60,10 +170,14 @@ class ExternalDownloader(Downloader):
 
     :param session: Requests session.
     :param bin: External downloader binary.
+
+    If fetch_validators is set, the ETag and Last-Modified of every finished
+    download are asked for with an extra HEAD request, for the manifest.
     """
 
     # External downloader binary
     bin = None
+    fetch_validators = False
 
     def __init__(self, session, bin=None):
         self.session = session
@@ -72,17 +186,23 @@ class ExternalDownloader(Downloader):
         if not self.bin:
             raise RuntimeError("No bin specified")
 
-    def _prepare_cookies(self, command, url):
+    def _get_cookie_values(self, url):
         """
-        Extract cookies from the requests session and add them to the command
+        Extract the cookies for url from the requests session.
         """
 
         req = requests.models.Request()
         req.method = 'GET'
         req.url = url
 
-        cookie_values = requests.cookies.get_cookie_header(
-            self.session.cookies, req)
+        return requests.cookies.get_cookie_header(self.session.cookies, req)
+
+    def _prepare_cookies(self, command, url):
+        """
+        Extract cookies from the requests session and add them to the command
+        """
+
+        cookie_values = self._get_cookie_values(url)
 
         if cookie_values:
             self._add_cookies(command, cookie_values)
@@ -100,17 +220,129 @@ class ExternalDownloader(Downloader):
         """
         raise NotImplementedError("Subclasses should implement this")
 
-    def _start_download(self, url, filename):
+    def _start_process(self, url, filename):
+        """
+        Spawn the external downloader for the given url and return the
+        running process.
+        """
         command = self._create_command(url, filename)
         self._prepare_cookies(command, url)
         logging.debug('Executing %s: %s', self.bin, command)
         try:
-            subprocess.call(command)
+            return subprocess.Popen(command)
         except OSError as e:
             msg = "{0}. Are you sure that '{1}' is the right bin?".format(
                 e, self.bin)
             raise OSError(msg)
 
+    def _check_modified(self, url, validators):
+        """
+        Ask the server whether url changed with a conditional HEAD request.
+        Returns the result of the download if it did not, None otherwise.
+        """
+        r = self.session.head(url, allow_redirects=True,
+                              headers=conditional_headers(validators))
+        if r.status_code == 304:
+            logging.info('Not modified: %s', url)
+            return not_modified_result(r, validators)
+        return None
+
+    def _finished_result(self, url):
+        """
+        Return the result of a finished download of url.  The external
+        downloaders do not tell the ETag and Last-Modified of the response,
+        so if fetch_validators is set they are asked for with a HEAD request,
+        for later conditional downloads.
+        """
+        if not self.fetch_validators:
+            return DownloadResult()
+        try:
+            r = self.session.head(url, allow_redirects=True)
+        except requests.exceptions.RequestException as e:
+            logging.debug('HEAD %s failed: %s', url, e)
+            return DownloadResult()
+        if r.status_code != 200:
+            return DownloadResult()
+        return DownloadResult(etag=r.headers.get('etag'),
+                              last_modified=r.headers.get('last-modified'))
+
+    def _start_download(self, url, filename, validators=None):
+        if validators:
+            result = self._check_modified(url, validators)
+            if result:
+                return result
+        if self._start_process(url, filename).wait() != 0:
+            return False
+        return self._finished_result(url)
+
+    def download_many(self, items, jobs=1, callback=None):
+        """
+        Download every (url, filename[, validators]) tuple in items, keeping
+        up to `jobs` external downloader processes running at the same time.
+        If given, callback is called with the url, the filename and the
+        result of each download.
+        """
+
+        running = []
+
+        def acquire():
+            return self.limit is None or self.limit.acquire(False)
+
+        def reap():
+            for process, url, filename in running[:]:
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                running.remove((process, url, filename))
+                if self.limit is not None:
+                    self.limit.release()
+                if callback:
+                    callback(url, filename,
+                             self._finished_result(url) if returncode == 0
+                             else False)
+
+        try:
+            for item in items:
+                url, filename = item[:2]
+                if len(item) > 2 and item[2]:
+                    result = self._check_modified(url, item[2])
+                    if result:
+                        if callback:
+                            callback(url, filename, result)
+                        continue
+                # the processes started here must be reaped while waiting
+                # for the shared limit, so do not block on it
+                while len(running) >= max(jobs, 1) or not acquire():
+                    self._check_abort()
+                    time.sleep(0.1)
+                    reap()
+                logging.info('Downloading: %s', filename)
+                try:
+                    process = self._start_process(url, filename)
+                except Exception:
+                    if self.limit is not None:
+                        self.limit.release()
+                    raise
+                running.append((process, url, filename))
+            while running:
+                self._check_abort()
+                time.sleep(0.1)
+                reap()
+        except KeyboardInterrupt:
+            for process, url, filename in running:
+                logging.info(
+                    'Keyboard Interrupt -- Removing partial file: %s',
+                    filename)
+                process.terminate()
+                process.wait()
+                if self.limit is not None:
+                    self.limit.release()
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            raise
+
 
 class WgetDownloader(ExternalDownloader):
     """
@@ -145,17 +377,175 @@ class Aria2Downloader(ExternalDownloader):
     """
     Uses aria2. Unfortunately, it does not give a nice visual feedback, but
     gets the job done much faster than the alternatives.
+
+    Several files are handed to a single aria2 process through an input
+    file, so that aria2 itself runs the downloads in parallel and reuses
+    its connections.  The downloads that failed or did not finish are those
+    aria2 lists in its session file on exit.  Their partial files are
+    removed, unless resuming, in which case aria2 continues them from its
+    control files (`filename + '.aria2'`) on the next run.
+
+    :param resume: Whether to keep and continue partially downloaded files.
     """
 
     bin = 'aria2c'
 
+    options = ['--check-certificate=false', '--log-level=notice',
+               '--max-connection-per-server=4', '--min-split-size=1M']
+
+    def __init__(self, session, bin=None, resume=False):
+        super(Aria2Downloader, self).__init__(session, bin)
+        self.resume = resume
+
     def _add_cookies(self, command, cookie_values):
         command.extend(['--header', "Cookie: " + cookie_values])
 
     def _create_command(self, url, filename):
-        return [self.bin, url, '-o', filename,
-                '--check-certificate=false', '--log-level=notice',
-                '--max-connection-per-server=4', '--min-split-size=1M']
+        return [self.bin, url, '-o', filename] + self.options
+
+    def _create_input_file(self, items):
+        """
+        Return the contents of an aria2 input file for the given (url,
+        filename) pairs.
+        """
+        lines = []
+        for url, filename in items:
+            lines.append(url)
+            lines.append('  dir=' + (os.path.dirname(filename) or '.'))
+            lines.append('  out=' + os.path.basename(filename))
+            cookie_values = self._get_cookie_values(url)
+            if cookie_values:
+                lines.append('  header=Cookie: ' + cookie_values)
+        return '\n'.join(lines) + '\n'
+
+    def _read_session(self, session_fn):
+        """
+        Return the absolute paths of the downloads listed in an aria2
+        session file, or None if aria2 did not write it.
+        """
+        if not os.path.exists(session_fn):
+            return None
+        entries = []
+        with open(session_fn) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if not line[0].isspace():
+                    entries.append({})
+                elif entries:
+                    key, _, value = line.strip().partition('=')
+                    entries[-1][key] = value
+        return set(os.path.abspath(os.path.join(entry.get('dir', '.'),
+                                                entry['out']))
+                   for entry in entries if 'out' in entry)
+
+    def _unfinished(self, batch, session_fn, returncode):
+        """
+        Return the filenames of the batch that aria2 did not download.
+        """
+        listed = self._read_session(session_fn)
+        if listed is None:
+            # all or nothing, going by the exit status
+            listed = set() if returncode == 0 else set(
+                os.path.abspath(filename) for url, filename in batch)
+        return set(filename for url, filename in batch
+                   if os.path.abspath(filename) in listed)
+
+    def _remove_partial(self, filenames):
+        """
+        Remove the files aria2 started but did not finish, which still
+        have a control file.  Files it did not get to are left alone.
+        """
+        for filename in filenames:
+            if not os.path.exists(filename + '.aria2'):
+                continue
+            logging.info('Removing partial file: %s', filename)
+            for fn in (filename, filename + '.aria2'):
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+
+    def download_many(self, items, jobs=1, callback=None):
+        """
+        Download every (url, filename[, validators]) tuple in items with a
+        single aria2 process running up to `jobs` downloads at a time.
+        If given, callback is called with the url, the filename and the
+        result of each download.
+        """
+
+        batch = []
+        for item in items:
+            url, filename = item[:2]
+            if len(item) > 2 and item[2]:
+                result = self._check_modified(url, item[2])
+                if result:
+                    if callback:
+                        callback(url, filename, result)
+                    continue
+            batch.append((url, filename))
+        if not batch:
+            return
+
+        fd, input_fn = tempfile.mkstemp(prefix='coursera-dl-',
+                                        suffix='.aria2')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self._create_input_file(batch))
+        session_fn = input_fn + '.session'
+
+        command = [self.bin, '-i', input_fn, '-j', str(max(jobs, 1)),
+                   '--allow-overwrite=true',
+                   '--save-session=' + session_fn] + self.options
+        if self.resume:
+            command.append('--continue=true')
+        logging.debug('Executing %s: %s', self.bin, command)
+        # the whole batch runs in one process, which holds one slot of limit
+        if self.limit is not None:
+            self.limit.acquire()
+        for url, filename in batch:
+            logging.info('Downloading: %s', filename)
+        try:
+            try:
+                process = subprocess.Popen(command)
+            except OSError as e:
+                os.remove(input_fn)
+                msg = "{0}. Are you sure that '{1}' is the right bin?".format(
+                    e, self.bin)
+                raise OSError(msg)
+
+            try:
+                while process.poll() is None:
+                    self._check_abort()
+                    time.sleep(0.1)
+            except KeyboardInterrupt:
+                # aria2 saves its session when terminated
+                process.terminate()
+                process.wait()
+                if not self.resume:
+                    self._remove_partial(self._unfinished(
+                        batch, session_fn, process.returncode))
+                raise
+            finally:
+                os.remove(input_fn)
+            unfinished = self._unfinished(batch, session_fn,
+                                          process.returncode)
+        finally:
+            if os.path.exists(session_fn):
+                os.remove(session_fn)
+            if self.limit is not None:
+                self.limit.release()
+
+        if not self.resume:
+            self._remove_partial(unfinished)
+        if callback:
+            def report(item):
+                url, filename = item
+                callback(url, filename,
+                         False if filename in unfinished
+                         else self._finished_result(url))
+
+            # the HEAD requests of _finished_result run `jobs` at a time
+            run_in_threads(report, batch, jobs, self.abort)
 
 
 class AxelDownloader(ExternalDownloader):
@@ -197,21 +587,29 @@ class DownloadProgress(object):
     Inspired by https://github.com/rg3/youtube-dl
     """
 
-    def __init__(self, total):
+    def __init__(self, total, quiet=False):
         if total in [0, '0', None]:
             self._total = None
         else:
             self._total = int(total)
 
         self._current = 0
+        self._offset = 0
         self._start = 0
         self._now = 0
 
         self._finished = False
+        self._quiet = quiet
 
-    def start(self):
+    def start(self, offset=0):
+        """
+        Start measuring.  The offset is the number of bytes that were
+        already downloaded by a previous attempt.
+        """
         self._now = time.time()
         self._start = self._now
+        self._offset = offset
+        self._current = offset
 
     def stop(self):
         self._now = time.time()
@@ -233,12 +631,15 @@ class DownloadProgress(object):
 
     def calc_speed(self):
         dif = self._now - self._start
-        if self._current == 0 or dif < 0.001:  # One millisecond
+        current = self._current - self._offset
+        if current == 0 or dif < 0.001:  # One millisecond
             return '---b/s'
-        return '{0}/s'.format(format_bytes(float(self._current) / dif))
+        return '{0}/s'.format(format_bytes(float(current) / dif))
 
     def report_progress(self):
         """Report download progress."""
+        if self._quiet:
+            return
         percent = self.calc_percent()
         total = format_bytes(self._total)
 
@@ -254,26 +655,128 @@ class DownloadProgress(object):
         sys.stdout.flush()
 
 
+def parse_content_range(value):
+    """
+    Parse a `Content-Range: bytes first-last/total` header value into a
+    (first, last, total) tuple.  Unknown parts are returned as None.
+    """
+    if not value:
+        return None, None, None
+    mobj = re.match(r'bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)', value.strip())
+    if not mobj:
+        return None, None, None
+    return tuple(int(v) if v and v != '*' else None for v in mobj.groups())
+
+
 class NativeDownloader(Downloader):
     """
     'Native' python downloader -- slower than the external downloaders.
 
+    In resume mode the data is written to `filename + '.part'`, which is kept
+    when the download is interrupted.  Retries (and later runs) continue from
+    the end of that file with a `Range` request and the file is only renamed
+    to its final name when it is complete.  The ETag of the response is kept
+    in `filename + '.part.etag'` and sent in `If-Range`, so that a file that
+    changed on the server is downloaded again instead of being resumed.
+
+    Large files can also be split into `segments` byte ranges which are
+    fetched concurrently on the same session and written into their place
+    in a preallocated `filename + '.part'`, which is renamed when it is
+    complete and removed on failure unless resuming.
+
+    Responses with a Content-Encoding (e.g., gzip) are decoded while they
+    are written to disk.  As their length and byte ranges refer to the
+    encoded data, they are not checked for truncation or resumed.
+
     :param session: Requests session.
+    :param retry_count: Number of attempts for each download.
+    :param resume: Whether to resume partially downloaded files.
+    :param segments: Maximum number of parallel connections per file.
     """
 
-    def __init__(self, session, retry_count=5):
+    # Files are not split into segments smaller than this
+    min_segment_size = 4 * 1048576
+
+    def __init__(self, session, retry_count=5, resume=False, segments=1):
         self.session = session
         self.retry_count = retry_count
+        self.resume = resume
+        self.segments = segments
 
-    def _start_download(self, url, filename):
+    def _start_download(self, url, filename, validators=None):
         logging.info('Downloading %s -> %s', url, filename)
 
+        part_fn = filename + '.part' if self.resume else filename
+
+        if self.segments > 1 and not (self.resume and
+                                      os.path.exists(part_fn)):
+            head = self._probe_segments(url, validators)
+            if head is not None and head.status_code == 304:
+                logging.info('Not modified: %s', url)
+                return not_modified_result(head, validators)
+            if head is not None:
+                size = int(head.headers['content-length'])
+                # the segments are written into a preallocated file, which
+                # only gets its final name once it is complete
+                segments_fn = filename + '.part'
+                if self.resume:
+                    self._write_etag(segments_fn, head.headers.get('etag'))
+                complete = False
+                try:
+                    self._download_segments(url, segments_fn, size)
+                    complete = True
+                except Exception as e:
+                    # the loop below starts over or resumes what we have
+                    logging.warn('Segmented download of %s failed: %s',
+                                 url, e)
+                finally:
+                    if not complete and not self.resume and \
+                            os.path.exists(segments_fn):
+                        os.remove(segments_fn)
+                if complete:
+                    self._finish_part(segments_fn, filename)
+                    return DownloadResult(
+                        size, head.headers.get('etag'),
+                        head.headers.get('last-modified'))
+
+        # the ETag of the response the part file was started from, so that
+        # it is only resumed if the file did not change since
+        etag = self._read_etag(part_fn) if self.resume else None
         attempts_count = 0
         error_msg = ''
         while attempts_count < self.retry_count:
-            r = self.session.get(url, stream=True)
+            offset = 0
+            headers = {}
+            if self.resume and os.path.exists(part_fn):
+                offset = os.path.getsize(part_fn)
+            if offset:
+                headers['Range'] = 'bytes={0}-'.format(offset)
+                # only get the rest if the file has not changed meanwhile
+                if etag and not etag.startswith('W/'):
+                    headers['If-Range'] = etag
+            elif validators:
+                headers.update(conditional_headers(validators))
+
+            r = self.session.get(url, stream=True, headers=headers)
+
+            if validators and not offset and r.status_code == 304:
+                logging.info('Not modified: %s', url)
+                r.close()
+                return not_modified_result(r, validators)
+
+            if offset and r.status_code == 416:
+                # nothing left to get, the part file may already be complete
+                first, last, total = parse_content_range(
+                    r.headers.get('content-range'))
+                r.close()
+                if total == offset:
+                    self._finish_part(part_fn, filename)
+                    return DownloadResult(total, etag)
+                logging.warn('Discarding unexpected partial file %s', part_fn)
+                os.remove(part_fn)
+                continue
 
-            if r.status_code is not 200:
+            if r.status_code not in (200, 206):
                 logging.warn(
                     'Probably the file is missing from the AWS repository...'
                     ' waiting.')
@@ -291,25 +794,222 @@ class NativeDownloader(Downloader):
                 continue
 
             content_length = r.headers.get('content-length')
-            progress = DownloadProgress(content_length)
+            total = int(content_length) if content_length else None
+            new_etag = r.headers.get('etag')
+            decode = r.headers.get('content-encoding',
+                                   'identity') != 'identity'
+            if decode:
+                total = None
+                if r.status_code == 206:
+                    logging.warn('Cannot resume encoded response, '
+                                 'restarting download of %s', filename)
+                    r.close()
+                    os.remove(part_fn)
+                    etag = None
+                    continue
+            if r.status_code == 206:
+                first, last, total = parse_content_range(
+                    r.headers.get('content-range'))
+                if first != offset or (etag and new_etag != etag):
+                    logging.warn('Resumed response does not match %s, '
+                                 'restarting download', part_fn)
+                    r.close()
+                    os.remove(part_fn)
+                    etag = None
+                    continue
+            elif offset:
+                logging.info('Server sent the whole file, restarting %s',
+                             filename)
+                offset = 0
+            etag = new_etag
+            if self.resume and not offset:
+                self._write_etag(part_fn, etag)
+
+            progress = self._create_progress(total)
             chunk_sz = 1048576
-            with open(filename, 'wb') as f:
-                progress.start()
-                while True:
-                    data = r.raw.read(chunk_sz)
-                    if not data:
-                        progress.stop()
-                        break
-                    progress.read(len(data))
-                    f.write(data)
-            r.close()
-            return True
+            try:
+                with open(part_fn, 'ab' if offset else 'wb') as f:
+                    progress.start(offset)
+                    while True:
+                        self._check_abort()
+                        if decode:
+                            data = r.raw.read(chunk_sz, decode_content=True)
+                        else:
+                            data = r.raw.read(chunk_sz)
+                        if not data:
+                            progress.stop()
+                            break
+                        progress.read(len(data))
+                        f.write(data)
+            except Exception as e:
+                if not self.resume:
+                    raise
+                error_msg = str(e)
+                if decode and os.path.exists(part_fn):
+                    # decoded data cannot be resumed with a byte range
+                    os.remove(part_fn)
+                wait_interval = 2 ** (attempts_count + 1)
+                logging.warn('Error while downloading %s: %s, will resume in '
+                             '%d seconds ...', url, e, wait_interval)
+                time.sleep(wait_interval)
+                attempts_count += 1
+                continue
+            finally:
+                r.close()
+
+            if self.resume:
+                size = os.path.getsize(part_fn)
+                if total is not None and size < total:
+                    error_msg = 'Got only {0} of {1} bytes'.format(size, total)
+                    logging.warn('%s, will resume', error_msg)
+                    attempts_count += 1
+                    continue
+                self._finish_part(part_fn, filename)
+            return DownloadResult(total, etag,
+                                  r.headers.get('last-modified'))
 
         if attempts_count == self.retry_count:
             logging.warn('Skipping, can\'t download file ...')
             logging.error(error_msg)
             return False
 
+    def _probe_segments(self, url, validators=None):
+        """
+        Return the HEAD response for url if the file is large enough to be
+        split and the server supports range requests, None otherwise.  With
+        validators, a 304 Not Modified response is returned as well.
+        """
+        headers = conditional_headers(validators) if validators else {}
+        try:
+            r = self.session.head(url, allow_redirects=True, headers=headers)
+        except requests.exceptions.RequestException as e:
+            logging.debug('HEAD %s failed: %s', url, e)
+            return None
+
+        if validators and r.status_code == 304:
+            return r
+        if r.status_code != 200:
+            return None
+        if r.headers.get('accept-ranges', '').lower() != 'bytes':
+            return None
+        size = int(r.headers.get('content-length') or 0)
+        if size < 2 * self.min_segment_size:
+            return None
+        return r
+
+    def _download_segments(self, url, filename, size):
+        """
+        Download the size bytes of url into filename using several
+        concurrent range requests.
+        """
+        count = min(self.segments, size // self.min_segment_size)
+        segment_size = size // count
+        ranges = [(i * segment_size, (i + 1) * segment_size - 1)
+                  for i in range(count)]
+        ranges[-1] = (ranges[-1][0], size - 1)
+        done = [0] * count
+
+        logging.debug('Downloading %s in %d segments', url, count)
+        with open(filename, 'wb') as f:
+            f.truncate(size)
+
+        abort = self.abort or threading.Event()
+        lock = threading.Lock()
+        progress = self._create_progress(size)
+        progress.start()
+        chunk_sz = 1048576
+
+        def fetch(i):
+            first, last = ranges[i]
+            headers = {'Range': 'bytes={0}-{1}'.format(first, last)}
+            r = self.session.get(url, stream=True, headers=headers)
+            try:
+                if r.status_code != 206:
+                    raise IOError('Range request answered with HTTP {0}'
+                                  .format(r.status_code))
+                c_first, c_last, c_total = parse_content_range(
+                    r.headers.get('content-range'))
+                if c_first != first or c_total != size:
+                    raise IOError('Unexpected Content-Range: {0}'.format(
+                        r.headers.get('content-range')))
+                with open(filename, 'r+b') as f:
+                    f.seek(first)
+                    remaining = last - first + 1
+                    while remaining:
+                        if abort.is_set():
+                            raise KeyboardInterrupt
+                        data = r.raw.read(min(chunk_sz, remaining))
+                        if not data:
+                            raise IOError('Connection closed with {0} bytes'
+                                          ' missing'.format(remaining))
+                        f.write(data)
+                        remaining -= len(data)
+                        done[i] += len(data)
+                        with lock:
+                            progress.read(len(data))
+            finally:
+                r.close()
+
+        try:
+            run_in_threads(fetch, range(count), count, abort)
+        except BaseException:
+            if self.resume:
+                # keep only the contiguous head of the file, so that it can
+                # be resumed with a single range request
+                prefix = 0
+                for (first, last), got in zip(ranges, done):
+                    prefix = first + got
+                    if got < last - first + 1:
+                        break
+                with open(filename, 'r+b') as f:
+                    f.truncate(prefix)
+            raise
+        progress.stop()
+
+    def _create_progress(self, total):
+        """
+        Return the progress report of a download.  Downloads running in
+        worker threads do not report it, as the reports of concurrent
+        downloads would overwrite each other on the same line.
+        """
+        quiet = threading.current_thread().name != 'MainThread'
+        return DownloadProgress(total, quiet)
+
+    def _read_etag(self, part_fn):
+        """
+        Return the ETag saved along with the part file, if both exist.
+        """
+        if not os.path.exists(part_fn):
+            return None
+        try:
+            with open(part_fn + '.etag') as f:
+                return f.read().strip() or None
+        except IOError:
+            return None
+
+    def _write_etag(self, part_fn, etag):
+        """
+        Save the ETag of the response a part file is downloaded from, so
+        that a later run can send it in If-Range.
+        """
+        etag_fn = part_fn + '.etag'
+        if etag:
+            with open(etag_fn, 'w') as f:
+                f.write(etag)
+        elif os.path.exists(etag_fn):
+            os.remove(etag_fn)
+
+    def _finish_part(self, part_fn, filename):
+        """
+        Move a completely downloaded part file to its final name.
+        """
+        if os.path.exists(part_fn + '.etag'):
+            os.remove(part_fn + '.etag')
+        if os.path.exists(filename):
+            # os.rename does not overwrite files on Windows
+            os.remove(filename)
+        os.rename(part_fn, filename)
+
 
 def is_native_downloader(downloader):
     return isinstance(downloader, NativeDownloader)
@@ -323,12 +1023,15 @@ def get_downloader(session, class_name, args):
     external = {
         'wget': WgetDownloader,
         'curl': CurlDownloader,
-        'aria2': Aria2Downloader,
         'axel': AxelDownloader,
     }
 
+    if args.aria2:
+        return Aria2Downloader(session, bin=args.aria2, resume=args.resume)
+
     for bin, class_ in iteritems(external):
         if getattr(args, bin):
             return class_(session, bin=getattr(args, bin))
 
-    return NativeDownloader(session, args.retry_count)
+    return NativeDownloader(session, args.retry_count, args.resume,
+                            args.segments)
@@ -14,23 +14,45 @@ import os
 import datetime
 import re
 import glob
-import itertools
-import operator
 import codecs
+import collections
 import string
 import json
 import logging
+import multiprocessing
 import shutil
+import sqlite3
 import subprocess
+import threading
 import calendar
+import hashlib
+import time
+import zlib
 from jinja2 import Environment, PackageLoader, Markup, evalcontextfilter
+from jinja2 import FileSystemBytecodeCache
 import markdown
+import six
 from . import utils
+from .define import PATH_CACHE
 
 
+page_fn_re = re.compile(r'^(?P<thread_id>\d+)-(?P<page>\d+)\.json$')
 hyperlink_re = re.compile(r'(https?://class.coursera.org)?/(?P<class_name>[-\w]+)/forum/(thread|list)\?(?P<type>thread|forum)_id=(?P<id>\d+)')
 punctuation_re = re.compile(r'([{}])'.format(string.punctuation))
 
+# Index of the downloaded threads, kept in the json dir
+FORUM_INDEX_FN = '.index.json'
+
+# Database of the downloaded pages, kept in the json dir
+PAGE_STORE_FN = 'pages.sqlite'
+
+MARKDOWN_CACHE_FN = os.path.join(PATH_CACHE, 'markdown.json')
+MARKDOWN_CACHE_SIZE = 20000
+MARKDOWN_VERSION = getattr(markdown, 'version', None) or markdown.__version__
+
+# compiled templates
+JINJA_CACHE_DIR = os.path.join(PATH_CACHE, 'jinja')
+
 
 def escape_punctuation(s):
     return punctuation_re.sub(r'\\\1', s)
@@ -40,7 +62,7 @@ def escape_punctuation(s):
 def post_to_html(eval_ctx, post, is_comment=False):
     text = post['post_text' if not is_comment else 'comment_text']
     if post['text_type'] == 'markdown':
-        text = markdown.markdown(text)
+        text = eval_ctx.environment.markdown_cache.convert(text)
     if eval_ctx.autoescape:
         text = Markup(text)
     return text
@@ -80,8 +102,142 @@ def get_rst_dir(class_name, path='', verbose_dirs=False):
     return get_forum_dir(class_name, 'rst', path, verbose_dirs)
 
 
-def get_jinja_env():
-    env = Environment(loader=PackageLoader('coursera', 'templates'))
+def get_html_dir(class_name, path='', verbose_dirs=False):
+    return get_forum_dir(class_name, 'html', path, verbose_dirs)
+
+
+class MarkdownCache(object):
+    """
+    Least recently used cache of the html of markdown texts, which can be
+    saved to a file to be reused by later runs.  Entries are keyed by the
+    hash of the text and the version of markdown.
+
+    :param filename: File the cache is loaded from and saved to, if any.
+    :param max_entries: Number of entries kept in the cache.
+    """
+
+    # the forums of several classes may be generated at the same time
+    _save_lock = threading.Lock()
+
+    def __init__(self, filename=None, max_entries=MARKDOWN_CACHE_SIZE):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.added = {}
+        self._markdown = markdown.Markdown()
+        self._load()
+
+    def _load(self):
+        self.entries.update(self._read())
+
+    def _read(self):
+        """
+        Return the entries saved in the file, least recently used first.
+        """
+        if not self.filename or not os.path.isfile(self.filename):
+            return []
+        try:
+            with codecs.open(self.filename, 'r', 'utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            logging.warn('Ignoring corrupt markdown cache %s', self.filename)
+            return []
+
+    def _key(self, text):
+        data = u'%s\0%s' % (MARKDOWN_VERSION, text)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _put(self, key, html):
+        self.entries[key] = html
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def convert(self, text):
+        """
+        Return the html of the markdown text.
+        """
+        key = self._key(text)
+        html = self.entries.pop(key, None)
+        if html is None:
+            self._markdown.reset()
+            html = self._markdown.convert(text)
+            self.added[key] = html
+        self._put(key, html)
+        return html
+
+    def pop_added(self):
+        """
+        Return and forget the entries added since the last call.
+        """
+        added, self.added = self.added, {}
+        return added
+
+    def update(self, entries):
+        """
+        Add entries converted elsewhere, e.g., by another process.
+        """
+        for key, html in six.iteritems(entries):
+            self.entries.pop(key, None)
+            self._put(key, html)
+            self.added[key] = html
+
+    def save(self):
+        """
+        Save the cache to its file if anything was added to it.  Entries
+        saved meanwhile by other classes are kept, as less recently used
+        than those of this cache.
+        """
+        if not self.filename or not self.pop_added():
+            return
+        with MarkdownCache._save_lock:
+            entries = collections.OrderedDict(
+                (key, html) for key, html in self._read()
+                if key not in self.entries)
+            entries.update(self.entries)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            utils.mkdir_p(os.path.dirname(self.filename))
+            tmp_fn = self.filename + '.tmp'
+            with codecs.open(tmp_fn, 'w', 'utf-8') as f:
+                f.write(json.dumps(list(entries.items())))
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmp_fn, self.filename)
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    """
+    Cache of compiled templates.  The files are replaced atomically, as
+    several render workers may compile the same template, and failing to
+    write them is not an error.
+    """
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        tmp_fn = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            with open(tmp_fn, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(tmp_fn, filename)
+        except (IOError, OSError) as e:
+            logging.debug('Could not cache template in %s: %s', filename, e)
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+
+
+def get_jinja_env(markdown_cache=None, bytecode_cache_dir=JINJA_CACHE_DIR):
+    bytecode_cache = None
+    if bytecode_cache_dir:
+        try:
+            utils.mkdir_p(bytecode_cache_dir, 0o700)
+        except OSError as e:
+            logging.warn('Not caching compiled templates in %s: %s',
+                         bytecode_cache_dir, e)
+        else:
+            bytecode_cache = BytecodeCache(bytecode_cache_dir)
+    env = Environment(loader=PackageLoader('coursera', 'templates'),
+                      bytecode_cache=bytecode_cache)
+    env.markdown_cache = markdown_cache or MarkdownCache()
     env.filters['html'] = post_to_html
     env.filters['timestamp'] = epoch_to_local
     env.filters['forum_ref'] = crumb_to_forum_ref
@@ -89,10 +245,111 @@ def get_jinja_env():
     return env
 
 
-def load_thread(thread_fn, load_pages=False):
-    with codecs.open(thread_fn, 'r', 'utf-8') as f:
-        thread = json.load(f)
-
+def find_thread_pages(json_dir):
+    """
+    Group the page files in json_dir by thread id with a single directory
+    scan.  Returns a dict mapping each thread id to the file names of its
+    pages, in page order.
+    """
+    pages = collections.defaultdict(list)
+    for basename in os.listdir(json_dir):
+        mobj = page_fn_re.match(basename)
+        if not mobj:
+            continue
+        pages[int(mobj.group('thread_id'))].append(
+            (int(mobj.group('page')), os.path.join(json_dir, basename)))
+    return dict((thread_id, [fn for page, fn in sorted(fns)])
+                for thread_id, fns in pages.items())
+
+
+class PageStore(object):
+    """
+    Downloaded thread pages kept compressed in a single SQLite database,
+    indexed by thread id and page, instead of one file per page.  It is
+    safe to use the store from several threads.
+
+    :param filename: Path of the database, created if needed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pages ('
+                           ' thread_id INTEGER NOT NULL,'
+                           ' page INTEGER NOT NULL,'
+                           ' data BLOB NOT NULL,'
+                           ' PRIMARY KEY (thread_id, page))')
+        self._conn.commit()
+
+    def has_page(self, thread_id, page):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM pages WHERE thread_id = ? AND page = ?',
+                (thread_id, page)).fetchone()
+        return row is not None
+
+    def get_page(self, thread_id, page):
+        """
+        Return the contents of the page as downloaded, or None if it is not
+        in the store.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data FROM pages WHERE thread_id = ? AND page = ?',
+                (thread_id, page)).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(bytes(row[0]))
+
+    def put_page(self, thread_id, page, data):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+                (thread_id, page, sqlite3.Binary(zlib.compress(data))))
+            self._conn.commit()
+
+    def import_page(self, thread_id, page, filename):
+        """
+        Move the page downloaded to filename into the store.
+        """
+        with open(filename, 'rb') as f:
+            self.put_page(thread_id, page, f.read())
+        os.remove(filename)
+
+    def thread_pages(self):
+        """
+        Return a dict mapping the id of each stored thread to its page
+        numbers, in order.
+        """
+        pages = collections.defaultdict(list)
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT thread_id, page FROM pages ORDER BY thread_id, page')
+            for thread_id, page in rows:
+                pages[thread_id].append(page)
+        return dict(pages)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_page_store_path(json_dir):
+    return os.path.join(json_dir, PAGE_STORE_FN)
+
+
+def open_page_store(json_dir):
+    """
+    Return the page store of json_dir, or None if there is none.
+    """
+    store_fn = get_page_store_path(json_dir)
+    if not os.path.isfile(store_fn):
+        return None
+    return PageStore(store_fn)
+
+
+def clean_thread(thread):
     thread['title'] = thread.get('title', '').strip()
     if not thread['title']:
         thread['title'] = 'untitled thread'
@@ -104,14 +361,55 @@ def load_thread(thread_fn, load_pages=False):
             crumb['title'] = 'untitled forum'
         crumb['fssafe_title'] = utils.clean_filename(crumb['title'])
 
+    thread['comments_by_post'] = {}
+    for comment in thread.get('comments', []):
+        add_comment(thread, comment)
+    return thread
+
+
+def add_comment(thread, comment):
+    """
+    Add the comment to the comments of its post in the thread's
+    comments_by_post index.
+    """
+    thread['comments_by_post'].setdefault(
+        comment.get('post_id'), []).append(comment)
+
+
+def merge_thread_page(thread, page):
+    """
+    Add the posts and comments of a later page to the thread.
+    """
+    for post in page['posts']:
+        if 'thread_id' not in post:
+            continue
+        thread['posts'].append(post)
+    for comment in page['comments']:
+        if 'post_id' not in comment:
+            continue
+        thread['comments'].append(comment)
+        add_comment(thread, comment)
+
+
+def load_thread(thread_fn, load_pages=False, page_fns=None):
+    """
+    Load the thread whose first page is in thread_fn.  With load_pages, the
+    posts and comments of the other pages are added as well; their file
+    names are looked up unless given as page_fns.
+    """
+    with codecs.open(thread_fn, 'r', 'utf-8') as f:
+        thread = clean_thread(json.load(f))
+
     if not load_pages:
         return thread
 
-    page_pattern = os.path.join(
-        os.path.dirname(thread_fn),
-        '{0}-*.json'.format(thread['id']))
+    if page_fns is None:
+        page_pattern = os.path.join(
+            os.path.dirname(thread_fn),
+            '{0}-*.json'.format(thread['id']))
+        page_fns = glob.glob(page_pattern)
     basename = os.path.basename(thread_fn)
-    for page_fn in glob.glob(page_pattern):
+    for page_fn in page_fns:
         if os.path.basename(page_fn) == basename:
             continue
         try:
@@ -119,20 +417,124 @@ def load_thread(thread_fn, load_pages=False):
                 page = json.load(f)
         except ValueError:
             continue
-        for post in page['posts']:
-            if 'thread_id' not in post:
-                continue
-            thread['posts'].append(post)
-        for comment in page['comments']:
-            if 'post_id' not in comment:
-                continue
-            thread['comments'].append(comment)
+        merge_thread_page(thread, page)
+    return thread
+
+
+def load_stored_thread(store, thread_id, pages):
+    """
+    Load the thread with the given pages from the page store.
+    """
+    thread = clean_thread(json.loads(store.get_page(thread_id, pages[0])))
+    for page in pages[1:]:
+        try:
+            merge_thread_page(thread,
+                              json.loads(store.get_page(thread_id, page)))
+        except ValueError:
+            continue
     return thread
 
 
+def list_threads(json_dir, store=None, max_threads=None):
+    """
+    Find the threads whose first page was downloaded to json_dir or to the
+    page store, in thread id order, reading the directory once.  Returns a
+    list of (thread_id, pages, stored) tuples, where pages are the page
+    numbers of a thread in the store (stored is True) or the file names of
+    its pages.
+    """
+    threads = []
+    pages = find_thread_pages(json_dir)
+    stored_pages = store.thread_pages() if store else {}
+    for thread_id in sorted(set(pages) | set(stored_pages)):
+        if max_threads and len(threads) >= max_threads:
+            break
+        if thread_id in stored_pages:
+            if stored_pages[thread_id][0] == 1:
+                threads.append((thread_id, stored_pages[thread_id], True))
+        elif pages[thread_id][0].endswith('-1.json'):
+            threads.append((thread_id, pages[thread_id], False))
+    return threads
+
+
+def load_listed_thread(store, listed, load_pages=True):
+    """
+    Load a thread found by list_threads.  Without load_pages, only its
+    first page is read.
+    """
+    thread_id, pages, stored = listed
+    if not load_pages:
+        pages = pages[:1]
+    if stored:
+        logging.debug('Reading thread %d from %s', thread_id, store.filename)
+        return load_stored_thread(store, thread_id, pages)
+    logging.debug('Reading %s', pages[0])
+    return load_thread(pages[0], load_pages=True, page_fns=pages[1:])
+
+
+def iter_threads(store, listed, load_pages=True):
+    """
+    Load the threads found by list_threads one at a time, skipping those
+    whose first page is broken.
+    """
+    for entry in listed:
+        try:
+            thread = load_listed_thread(store, entry, load_pages)
+        except ValueError:
+            continue
+        yield thread
+
+
+def load_threads(json_dir, max_threads=None, load_pages=True):
+    """
+    Load the threads in json_dir one at a time, in thread id order, parsing
+    every page file once.  Threads in the page store of json_dir are read
+    from there.  Without load_pages, only the first page of each thread is
+    read, e.g., for its title and forums.
+    """
+    store = open_page_store(json_dir)
+    try:
+        listed = list_threads(json_dir, store, max_threads)
+        for thread in iter_threads(store, listed, load_pages):
+            yield thread
+    finally:
+        if store:
+            store.close()
+
+
 def render_thread(template, thread, context):
     prepare_thread(thread, context)
-    return template.render(ref=context['ref'], **thread)
+    return template.render(ref=context['ref'],
+                           root=context.get('root'),
+                           forums=context['forums'],
+                           url=lambda node: node_url(node, context),
+                           static_url=static_url(context),
+                           **thread)
+
+
+def node_url(node, context):
+    """
+    Return the link to the html page of node from the current page.  The
+    links are memoized in context['urls'] by page directory and target.
+    """
+    urls = context.setdefault('urls', {})
+    key = (context['dirname'], node.html_path)
+    url = urls.get(key)
+    if url is None:
+        url = urls[key] = os.path.relpath(node.html_path, context['dirname'])
+    return url
+
+
+def static_url(context):
+    """
+    Return the link to the static files of the html backend from the
+    current page.
+    """
+    if context.get('root') is None:
+        return None
+    return os.path.relpath(
+        os.path.join(os.path.dirname(context['root'].html_path), '_static'),
+        context['dirname'])
 
 
 def prepare_thread(thread, context):
@@ -144,13 +546,17 @@ def prepare_thread(thread, context):
             if text_key not in text:
                 continue
             text[text_key] = replace_links(text[text_key], context)
-    thread['comments_by_post'] = {
-        key: list(comments)
-        for key, comments in itertools.groupby(
-                thread['comments'], operator.itemgetter('post_id'))}
+    if 'comments_by_post' not in thread:
+        # not loaded by load_thread
+        thread['comments_by_post'] = {}
+        for comment in thread['comments']:
+            add_comment(thread, comment)
 
 
 def replace_links(s, context):
+    if '/forum/' not in s:
+        # cannot contain any link to rewrite
+        return s
     s = hyperlink_re.sub(lambda matchobj: url_for(matchobj, context), s)
     return s
 
@@ -163,9 +569,7 @@ def url_for(matchobj, context):
     object_id = long(matchobj.group('id'))
     if object_id not in context[object_key]:
         return matchobj.group(0)
-    return os.path.relpath(
-        context[object_key][object_id].html_path,
-        context['dirname'])
+    return node_url(context[object_key][object_id], context)
 
 
 class TOCNode(dict):
@@ -177,12 +581,12 @@ class TOCNode(dict):
     def make_ref(cls, **context):
         return u'{ref_prefix}_{node_id}'.format(**context)
 
-    def __init__(self, node_id, title, path):
+    def __init__(self, node_id, title, path, html_path=None):
         super(TOCNode, self).__init__()
         self.node_id = node_id
         self.title = title
         self.path = path
-        self.html_path = path.replace('rst', 'html')
+        self.html_path = html_path or path.replace('rst', 'html')
         self.basename, _ = os.path.splitext(os.path.basename(path))
         self.ref = self.make_ref(ref_prefix=self.ref_prefix, **self.__dict__)
 
@@ -249,7 +653,13 @@ class TOCThreadNode(TOCNode):
         return super(TOCThreadNode, self).__lt__(other)
 
 
-def build_toc_index(class_name, json_dir, rst_dir, max_threads=None):
+def build_toc_index(class_name, json_dir, rst_dir, max_threads=None,
+                    threads=None):
+    """
+    Build the tree of forums and threads and the index of their nodes by
+    id.  Only the title and forums of the threads are used, so just their
+    first pages are loaded from json_dir, unless the threads are given.
+    """
     def format_thread_fn(thread_id, title, *crumbs):
         filename = '%d_%s.rst' % (thread_id, utils.clean_filename(title)[:100])
         return os.path.join(rst_dir, *crumbs), filename
@@ -257,15 +667,18 @@ def build_toc_index(class_name, json_dir, rst_dir, max_threads=None):
     def format_forum_fn(*crumbs):
         return os.path.join(rst_dir, *crumbs), 'index.rst'
 
-    root = TOCRootNode(0, class_name, os.path.join(*format_forum_fn()))
+    html_dir = os.path.join(os.path.dirname(rst_dir), 'html')
+
+    def format_html_fn(rst_fn):
+        html_fn = os.path.splitext(os.path.relpath(rst_fn, rst_dir))[0]
+        return os.path.join(html_dir, html_fn + '.html')
+
+    root_fn = os.path.join(*format_forum_fn())
+    root = TOCRootNode(0, class_name, root_fn, format_html_fn(root_fn))
     index = {'threads': {}, 'forums': {}}
-    for i, json_fn in enumerate(glob.glob(os.path.join(json_dir, '*-1.json'))):
-        if max_threads and i >= max_threads:
-            break
-        try:
-            thread = load_thread(json_fn)
-        except ValueError:
-            continue
+    if threads is None:
+        threads = load_threads(json_dir, max_threads, load_pages=False)
+    for thread in threads:
         crumbs = thread['crumbs'][1:]
         base_dir, filename = format_thread_fn(
             thread['id'],
@@ -273,7 +686,8 @@ def build_toc_index(class_name, json_dir, rst_dir, max_threads=None):
             *[crumb['fssafe_title'] for crumb in crumbs])
         utils.mkdir_p(base_dir)
         thread_fn = os.path.join(base_dir, filename)
-        thread_node = TOCThreadNode(thread['id'], thread['title'], thread_fn)
+        thread_node = TOCThreadNode(thread['id'], thread['title'], thread_fn,
+                                    format_html_fn(thread_fn))
         index['threads'][thread['id']] = thread_node
 
         # build forum toctree
@@ -281,68 +695,191 @@ def build_toc_index(class_name, json_dir, rst_dir, max_threads=None):
         for i, subforum in enumerate(crumbs):
             forum_ref = crumb_to_forum_ref(subforum)
             if forum_ref not in toctree:
+                forum_fn = os.path.join(*format_forum_fn(*[crumb['fssafe_title'] for crumb in crumbs[:i+1]]))
                 forum_node = TOCForumNode(
                     subforum['forum_id'],
                     subforum['title'],
-                    os.path.join(*format_forum_fn(*[crumb['fssafe_title'] for crumb in crumbs[:i+1]])),
+                    forum_fn,
+                    format_html_fn(forum_fn),
                 )
                 toctree[forum_ref] = forum_node
                 index['forums'][subforum['forum_id']] = forum_node
             toctree = toctree[forum_ref]
         toctree[thread_node.ref] = thread_node
 
-        logging.info('Read %s', json_fn)
     return root, index
 
 
-def generate_forum(class_name, path='', verbose_dirs=False, max_threads=None):
-    # render threads
-    env = get_jinja_env()
+def write_if_changed(filename, content):
+    """
+    Write content to filename unless the file already has exactly that
+    content.  Leaving unchanged files alone keeps their mtime, so that
+    sphinx-build only rebuilds the documents that did change.
+
+    Return whether the file was written.
+    """
+    if os.path.isfile(filename):
+        with codecs.open(filename, 'r', 'utf-8') as f:
+            if f.read() == content:
+                logging.debug('Unchanged %s', filename)
+                return False
+
+    with codecs.open(filename, 'w', 'utf-8') as f:
+        f.write(content)
+    return True
+
+
+def write_thread(template, thread, context, html=False):
+    """
+    Render the thread into the rst file of its node in the index, or
+    straight into its html file if html is True.
+    """
+    thread_node = context['threads'][thread['id']]
+    thread_fn = thread_node.html_path if html else thread_node.path
+    utils.mkdir_p(os.path.dirname(thread_fn))
+    context['dirname'] = os.path.dirname(thread_node.html_path)
+    context['ref'] = thread_node.ref
+
+    if write_if_changed(thread_fn, render_thread(template, thread, context)):
+        logging.info('Wrote %s', thread_fn)
+
+
+# per process state of the rendering workers
+_render_worker = {}
+
+
+def _init_render_worker(template_name, context, html, markdown_cache_fn,
+                        bytecode_cache_dir, json_dir):
+    env = get_jinja_env(MarkdownCache(markdown_cache_fn), bytecode_cache_dir)
+    _render_worker['template'] = env.get_template(template_name)
+    _render_worker['context'] = context
+    _render_worker['html'] = html
+    _render_worker['store'] = open_page_store(json_dir)
+
+
+def _render_in_worker(listed):
+    template = _render_worker['template']
+    try:
+        thread = load_listed_thread(_render_worker['store'], listed)
+    except ValueError:
+        return {}
+    write_thread(template, thread,
+                 dict(_render_worker['context']), _render_worker['html'])
+    # hand the new conversions back to be saved by the parent
+    return template.environment.markdown_cache.pop_added()
+
+
+def render_threads(template, json_dir, listed, context, jobs=1, html=False):
+    """
+    Render the threads of json_dir found by list_threads, loading them one
+    at a time, using a pool of `jobs` processes if jobs > 1.  The context
+    (with the index of all threads and forums) is sent to every worker
+    once, the listed threads are sent in chunks and loaded by the workers.
+    The markdown conversions done by the workers are collected in the cache
+    of the template's environment, whose compiled templates cache they share.
+    """
+    if jobs <= 1:
+        store = open_page_store(json_dir)
+        try:
+            for thread in iter_threads(store, listed):
+                write_thread(template, thread, context, html)
+        finally:
+            if store:
+                store.close()
+        return
+
+    markdown_cache = template.environment.markdown_cache
+    bytecode_cache = template.environment.bytecode_cache
+    pool = multiprocessing.Pool(jobs, _init_render_worker,
+                                (template.name, context, html,
+                                 markdown_cache.filename,
+                                 bytecode_cache and bytecode_cache.directory,
+                                 json_dir))
+    try:
+        for added in pool.imap_unordered(_render_in_worker, listed,
+                                         chunksize=16):
+            markdown_cache.update(added)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def generate_forum(class_name, path='', verbose_dirs=False, max_threads=None,
+                   jobs=1, backend='sphinx', sphinx_jobs=None,
+                   markdown_cache_fn=MARKDOWN_CACHE_FN,
+                   bytecode_cache_dir=JINJA_CACHE_DIR):
+    """
+    Generate the forum viewer of the downloaded threads.
+
+    With the 'sphinx' backend, the threads and forum indexes are rendered to
+    rst and sphinx-build turns them into html.  The 'html' backend renders
+    the html pages directly, which is much faster for large forums but has
+    no search.
+
+    sphinx_jobs is the number of processes passed to sphinx-build as -j to
+    build in parallel.  The doctrees are kept in a directory next to the
+    rst dir so that later builds are incremental.
+
+    The html of the markdown posts is cached in markdown_cache_fn, and the
+    compiled templates in bytecode_cache_dir (not cached if None).
+    """
+    html = backend == 'html'
+    env = get_jinja_env(MarkdownCache(markdown_cache_fn), bytecode_cache_dir)
     json_dir = get_json_dir(class_name, path, verbose_dirs)
     rst_dir = get_rst_dir(class_name, path, verbose_dirs)
-    thread_template = env.get_template('forum/thread.rst')
-    index_template = env.get_template('forum/index.rst')
-
-    utils.mkdir_p(rst_dir)
+    html_dir = get_html_dir(class_name, path, verbose_dirs)
+    template_ext = 'html' if html else 'rst'
+    thread_template = env.get_template('forum/thread.' + template_ext)
+    index_template = env.get_template('forum/index.' + template_ext)
 
-    # copy conf
-    for template_fn, dest_fn in [
+    if html:
+        conf_files = [
+            ('forum/custom.css', ['_static', 'custom.css']),
+            ('forum/basic.css', ['_static', 'basic.css']),
+        ]
+        out_dir = html_dir
+    else:
+        conf_files = [
             ('forum/conf.py', ['conf.py']),
             ('forum/custom.css', ['_static', 'custom.css']),
             ('forum/layout.html', ['_templates', 'layout.html']),
             ('forum/Makefile', ['Makefile']),
             ('forum/make.bat', ['make.bat']),
-    ]:
-        dest = os.path.join(rst_dir, *dest_fn)
+        ]
+        out_dir = rst_dir
+
+    utils.mkdir_p(out_dir)
+
+    # copy conf
+    for template_fn, dest_fn in conf_files:
+        dest = os.path.join(out_dir, *dest_fn)
         utils.mkdir_p(os.path.dirname(dest))
-        with codecs.open(dest, 'w', 'utf-8') as f:
-            f.write(env.get_template(template_fn).render(class_name=class_name))
-
-    toctree, index = build_toc_index(
-        class_name,
-        json_dir=json_dir,
-        rst_dir=rst_dir,
-        max_threads=max_threads)
+        write_if_changed(
+            dest, env.get_template(template_fn).render(class_name=class_name))
+
+    # only the first pages are read to build the index, the threads are
+    # loaded again one at a time while rendering them
+    store = open_page_store(json_dir)
+    try:
+        listed = list_threads(json_dir, store, max_threads)
+        toctree, index = build_toc_index(
+            class_name,
+            json_dir=json_dir,
+            rst_dir=rst_dir,
+            threads=iter_threads(store, listed, load_pages=False))
+    finally:
+        if store:
+            store.close()
     context = dict(
         class_name=class_name,
+        root=toctree,
+        urls={},
         **index)
 
-    for i, json_fn in enumerate(glob.glob(os.path.join(json_dir, '*-1.json'))):
-        if max_threads and i >= max_threads:
-            break
-        try:
-            thread = load_thread(json_fn, load_pages=True)
-        except ValueError:
-            continue
-        thread_node = index['threads'][thread['id']]
-        utils.mkdir_p(os.path.dirname(thread_node.path))
-        context['dirname'] = os.path.dirname(thread_node.html_path)
-        context['ref'] = thread_node.ref
-
-        with codecs.open(thread_node.path, 'w', 'utf-8') as f:
-            f.write(render_thread(thread_template, thread, context))
-
-        logging.info('Wrote %s', thread_node.path)
+    render_threads(thread_template, json_dir, listed, context, jobs, html)
 
     def walk_tree(tree, path=[]):
         items = sorted([(v, k) for k, v in tree.iteritems()])
@@ -355,16 +892,33 @@ def generate_forum(class_name, path='', verbose_dirs=False, max_threads=None):
                 yield child, subpath, entries
 
     for node, crumbs, entries in walk_tree(toctree):
-        with codecs.open(node.path, 'w', 'utf-8') as f:
-            index = index_template.render(
-                is_root=node.is_root,
-                ref=node.ref,
-                title=node.title,
-                crumbs=crumbs,
-                entries=entries)
-            f.write(index)
+        context['dirname'] = os.path.dirname(node.html_path)
+        index = index_template.render(
+            is_root=node.is_root,
+            ref=node.ref,
+            title=node.title,
+            crumbs=crumbs,
+            entries=entries,
+            root=toctree,
+            url=lambda node: node_url(node, context),
+            static_url=static_url(context))
+        node_fn = node.html_path if html else node.path
+        utils.mkdir_p(os.path.dirname(node_fn))
+        write_if_changed(node_fn, index)
+
+    env.markdown_cache.save()
+
+    if html:
+        return
 
     # run sphinx-build
-    subprocess.call(' '.join(['sphinx-build', '-b', 'html', 'rst', 'html']),
-                    cwd=os.path.dirname(rst_dir),
-                    shell=True)
+    cmd = ['sphinx-build', '-b', 'html', '-d', 'doctrees']
+    if sphinx_jobs:
+        cmd.extend(['-j', str(sphinx_jobs)])
+    cmd.extend(['rst', 'html'])
+
+    start = time.time()
+    ret = subprocess.call(cmd, cwd=os.path.dirname(rst_dir))
+    if ret:
+        logging.error('sphinx-build failed with exit code %s', ret)
+    logging.info('Built the forum viewer in %.1fs', time.time() - start)
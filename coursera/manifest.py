@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""
+Keeps a per-class record (a "manifest") of the files that were downloaded.
+
+The manifest is an append-only file with one JSON object per line.  Each
+line describes one downloaded file and later lines override earlier ones for
+the same file, so a download interrupted half-way through can be told apart
+from a complete one without looking at the file itself.
+"""
+
+import codecs
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from .utils import mkdir_p
+
+MANIFEST_FN = '.coursera-dl-manifest.jsonl'
+
+# Entries with these statuses are considered to be on disk and complete
+DONE_STATUSES = ('complete', 'existing')
+
+
+def get_manifest_path(class_name, path=''):
+    """
+    Return the path of the manifest of the given class.
+    """
+    return os.path.join(path, class_name, MANIFEST_FN)
+
+
+def checksum_file(filename, chunk_sz=1048576):
+    """
+    Return the MD5 hex digest of the contents of filename.
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(chunk_sz)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+
+class Manifest(object):
+    """
+    Record of the downloaded files of a class.
+
+    Files are identified by their path relative to the directory of the
+    manifest, so the same manifest can be used from any working directory.
+    It is safe to update the manifest from several threads.
+
+    :param filename: Path of the manifest file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.base_dir = os.path.dirname(filename)
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _key(self, filename):
+        return os.path.relpath(filename, self.base_dir)
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+
+        lines = 0
+        with codecs.open(self.filename, 'r', 'utf-8') as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # probably the last line of an interrupted run
+                    logging.debug('Ignoring bad manifest line: %r', line)
+                    continue
+                self.entries[entry['path']] = entry
+        logging.debug('Read %d manifest entries from %s',
+                      len(self.entries), self.filename)
+
+        # get rid of superseded lines once they pile up
+        if lines > 2 * len(self.entries) + 100:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the manifest with only the latest entry of every file.
+        """
+        with self._lock:
+            tmp_fn = self.filename + '.tmp'
+            with codecs.open(tmp_fn, 'w', 'utf-8') as f:
+                for key in sorted(self.entries):
+                    f.write(json.dumps(self.entries[key]) + '\n')
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmp_fn, self.filename)
+
+    def get(self, filename):
+        """
+        Return the entry of the given file or None if there is none.
+        """
+        return self.entries.get(self._key(filename))
+
+    def is_done(self, filename):
+        """
+        Whether the given file is known to be completely downloaded.
+        """
+        entry = self.get(filename)
+        return entry is not None and entry.get('status') in DONE_STATUSES
+
+    def update(self, filename, **fields):
+        """
+        Update the entry of the given file with fields and append it to the
+        manifest.
+        """
+        key = self._key(filename)
+        with self._lock:
+            entry = dict(self.entries.get(key, {}))
+            entry.update(fields)
+            entry['path'] = key
+            entry['updated'] = time.time()
+            self.entries[key] = entry
+
+            mkdir_p(self.base_dir)
+            with codecs.open(self.filename, 'a', 'utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def record_existing(self, url, filename):
+        """
+        Record a file that was already on disk, e.g., from a run without
+        a manifest.
+        """
+        return self.update(filename,
+                           url=url,
+                           status='existing',
+                           size=os.path.getsize(filename),
+                           mtime=os.path.getmtime(filename))
+
+    def record_download(self, url, filename, result):
+        """
+        Record the outcome of downloading url to filename.  result is what
+        the downloader returned; a download that yielded fewer bytes than
+        announced by the server is recorded as 'partial', and a file found
+        to be unchanged only gets its validators refreshed.
+        """
+        if not result or not os.path.exists(filename):
+            return self.update(filename, url=url, status='failed')
+
+        if getattr(result, 'not_modified', False):
+            return self.update(filename,
+                               url=url,
+                               etag=result.etag,
+                               last_modified=result.last_modified)
+
+        size = os.path.getsize(filename)
+        expected_size = getattr(result, 'size', None)
+        if expected_size is not None and expected_size != size:
+            logging.warn('%s is truncated (%d of %d bytes)',
+                         filename, size, expected_size)
+            status = 'partial'
+        else:
+            status = 'complete'
+
+        return self.update(filename,
+                           url=url,
+                           status=status,
+                           size=size,
+                           mtime=os.path.getmtime(filename),
+                           etag=getattr(result, 'etag', None),
+                           last_modified=getattr(result, 'last_modified',
+                                                 None),
+                           checksum=checksum_file(filename))
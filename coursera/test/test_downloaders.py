@@ -4,6 +4,9 @@
 Test the downloaders.
 """
 
+import os
+import threading
+import time
 import unittest
 
 from coursera import downloaders
@@ -117,6 +120,82 @@ class ExternalDownloaderTestCase(unittest.TestCase):
         self.assertTrue(any("csrf_token=csrfclass001" in e for e in command))
         self.assertTrue(any("session=sessionclass1" in e for e in command))
 
+    def test_aria2_input_file(self):
+        s = self._get_session()
+
+        d = downloaders.Aria2Downloader(s)
+        contents = d._create_input_file([
+            ('http://www.coursera.org/1.mp4', os.path.join('a', '1.mp4')),
+            ('http://www.example.org/2.pdf', '2.pdf'),
+        ])
+        lines = contents.splitlines()
+
+        self.assertEquals(lines[0], 'http://www.coursera.org/1.mp4')
+        self.assertEquals(lines[1], '  dir=a')
+        self.assertEquals(lines[2], '  out=1.mp4')
+        self.assertTrue(lines[3].startswith('  header=Cookie: '))
+        self.assertTrue('session=sessionclass1' in lines[3])
+        self.assertEquals(lines[4:], ['http://www.example.org/2.pdf',
+                                      '  dir=.',
+                                      '  out=2.pdf',
+                                      '  header=Cookie: k=v'])
+
+    def test_aria2_download_many_runs_one_process(self):
+        from mock import MagicMock, patch
+
+        d = downloaders.Aria2Downloader(self._get_session())
+        popen_mock = MagicMock()
+        popen_mock.return_value.poll.return_value = 0
+        popen_mock.return_value.returncode = 0
+        results = []
+        with patch('subprocess.Popen', popen_mock),\
+                patch.object(d.session, 'head',
+                             return_value=MockResponse(200)):
+            d.download_many([('url1', 'file1'), ('url2', 'file2')], jobs=3,
+                            callback=lambda *args: results.append(args))
+
+        self.assertEquals(popen_mock.call_count, 1)
+        command = popen_mock.call_args[0][0]
+        self.assertEquals(command[:2], ['aria2c', '-i'])
+        self.assertEquals(command[3:5], ['-j', '3'])
+        self.assertEquals(sorted(r[:2] for r in results),
+                          [('url1', 'file1'), ('url2', 'file2')])
+        self.assertTrue(all(r[2] for r in results))
+
+    def test_aria2_reports_unfinished_downloads(self):
+        import shutil
+        import tempfile
+        from mock import MagicMock, patch
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        file1 = os.path.join(tmpdir, 'file1')
+        file2 = os.path.join(tmpdir, 'file2')
+
+        def popen(command):
+            # file1 is complete, file2 failed half-way through
+            for fn in [file1, file2, file2 + '.aria2']:
+                open(fn, 'w').close()
+            session_fn = [arg.split('=', 1)[1] for arg in command
+                          if arg.startswith('--save-session=')][0]
+            with open(session_fn, 'w') as f:
+                f.write('url2\n dir=%s\n out=file2\n' % tmpdir)
+            process = MagicMock()
+            process.poll.return_value = process.returncode = 1
+            return process
+
+        d = downloaders.Aria2Downloader(self._get_session())
+        results = []
+        with patch('subprocess.Popen', popen),\
+                patch.object(d.session, 'head',
+                             return_value=MockResponse(200)):
+            d.download_many([('url1', file1), ('url2', file2)],
+                            callback=lambda *args: results.append(args))
+
+        self.assertTrue(results[0][2])
+        self.assertFalse(results[1][2])
+        self.assertEquals(os.listdir(tmpdir), ['file1'])
+
     def test_axel(self):
         s = self._get_session()
 
@@ -131,6 +210,67 @@ class ExternalDownloaderTestCase(unittest.TestCase):
         self.assertTrue(any("csrf_token=csrfclass001" in e for e in command))
         self.assertTrue(any("session=sessionclass1" in e for e in command))
 
+    def test_download_many_limits_running_processes(self):
+        class MockProcess(object):
+            running = 0
+            max_running = 0
+
+            def __init__(self):
+                MockProcess.running += 1
+                MockProcess.max_running = max(MockProcess.max_running,
+                                              MockProcess.running)
+                self.polls = 0
+
+            def poll(self):
+                self.polls += 1
+                if self.polls < 2:
+                    return None
+                MockProcess.running -= 1
+                return 0
+
+        started = []
+
+        def mock_start_process(url, filename):
+            started.append((url, filename))
+            return MockProcess()
+
+        d = downloaders.ExternalDownloader(None, bin='test')
+        d._start_process = mock_start_process
+        items = [('url%d' % i, 'file%d' % i) for i in range(5)]
+        d.download_many(items, jobs=2)
+
+        self.assertEquals(started, items)
+        self.assertEquals(MockProcess.max_running, 2)
+        self.assertEquals(MockProcess.running, 0)
+
+    def test_download_many_holds_shared_limit(self):
+        limit = threading.BoundedSemaphore(1)
+        started = []
+
+        class MockProcess(object):
+
+            def __init__(self):
+                self.polls = 0
+
+            def poll(self):
+                self.polls += 1
+                return 0 if self.polls >= 2 else None
+
+        def mock_start_process(url, filename):
+            # the only slot is taken by this download
+            started.append(limit.acquire(False))
+            return MockProcess()
+
+        d = downloaders.ExternalDownloader(None, bin='test')
+        d.limit = limit
+        d._start_process = mock_start_process
+        d.download_many([('url%d' % i, 'file%d' % i) for i in range(4)],
+                        jobs=2)
+
+        self.assertEquals(started, [False] * 4)
+        # every slot was given back
+        self.assertTrue(limit.acquire(False))
+
 
 class NativeDownloaderTestCase(unittest.TestCase):
 
@@ -142,7 +282,7 @@ class NativeDownloaderTestCase(unittest.TestCase):
 
         class MockSession:
 
-            def get(self, url, stream=True):
+            def get(self, url, stream=True, headers=None):
                 object_ = IObject()
                 object_.status_code = 400
                 object_.reason = None
@@ -157,6 +297,379 @@ class NativeDownloaderTestCase(unittest.TestCase):
 
         time.sleep = _sleep
 
+    def test_download_many(self):
+        d = downloaders.NativeDownloader(None)
+        downloaded = []
+        d._start_download = lambda url, filename: downloaded.append(filename)
+
+        items = [('url%d' % i, 'file%d' % i) for i in range(10)]
+        d.download_many(items, jobs=3)
+        self.assertEquals(sorted(downloaded), sorted(f for u, f in items))
+
+    def test_interrupted_downloads_are_removed(self):
+        import io
+        import shutil
+        import tempfile
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        abort = threading.Event()
+
+        class MockRaw(io.BytesIO):
+
+            def read(self, size=-1):
+                # Ctrl-C while the workers are writing
+                abort.set()
+                return io.BytesIO.read(self, 4)
+
+        class MockSession(object):
+
+            def get(self, url, stream=True, headers=None):
+                response = MockResponse(200, headers={'content-length': '10'})
+                response.raw = MockRaw(b'0123456789')
+                return response
+
+        d = downloaders.NativeDownloader(MockSession())
+        d.abort = abort
+        items = [('url%d' % i, os.path.join(tmpdir, 'file%d' % i))
+                 for i in range(3)]
+        self.assertRaises(KeyboardInterrupt, d.download_many, items, 3)
+        self.assertEquals(os.listdir(tmpdir), [])
+
+    def test_download_limit_is_shared(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def mock_start_download(url, filename, validators=None):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        limit = threading.BoundedSemaphore(2)
+        threads = []
+        for i in range(2):
+            d = downloaders.NativeDownloader(None)
+            d.limit = limit
+            d._start_download = mock_start_download
+            items = [('url%d' % j, 'file%d' % j) for j in range(6)]
+            threads.append(threading.Thread(target=d.download_many,
+                                            args=(items, 3)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(running, [0, 2])
+
+
+class MockResponse(object):
+
+    def __init__(self, status_code, body=b'', headers=None):
+        import io
+
+        self.status_code = status_code
+        self.reason = None
+        self.headers = headers or {}
+        self.raw = io.BytesIO(body)
+
+    def close(self):
+        pass
+
+
+class ResumeTestCase(unittest.TestCase):
+
+    body = b'0123456789'
+
+    def setUp(self):
+        import tempfile
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'video.mp4')
+        self.requests = []
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.tmpdir)
+
+    def _get_downloader(self, *responses):
+        responses = list(responses)
+
+        class MockSession(object):
+
+            def get(session, url, stream=True, headers=None):
+                self.requests.append(headers)
+                return responses.pop(0)
+
+        d = downloaders.NativeDownloader(MockSession(), resume=True)
+        return d
+
+    def _write_part(self, data):
+        with open(self.filename + '.part', 'wb') as f:
+            f.write(data)
+
+    def _read(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def test_parse_content_range(self):
+        self.assertEquals(downloaders.parse_content_range('bytes 3-9/10'),
+                          (3, 9, 10))
+        self.assertEquals(downloaders.parse_content_range('bytes */10'),
+                          (None, None, 10))
+        self.assertEquals(downloaders.parse_content_range(None),
+                          (None, None, None))
+
+    def test_resume_partial_file(self):
+        self._write_part(self.body[:3])
+        d = self._get_downloader(MockResponse(
+            206, self.body[3:], {'content-range': 'bytes 3-9/10'}))
+
+        self.assertTrue(d._start_download('url', self.filename))
+        self.assertEquals(self.requests[0]['Range'], 'bytes=3-')
+        self.assertEquals(self._read(), self.body)
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+
+    def test_resume_with_saved_etag(self):
+        self._write_part(self.body[:3])
+        with open(self.filename + '.part.etag', 'w') as f:
+            f.write('"v1"')
+        d = self._get_downloader(MockResponse(
+            206, self.body[3:], {'content-range': 'bytes 3-9/10',
+                                 'etag': '"v1"'}))
+
+        self.assertTrue(d._start_download('url', self.filename))
+        self.assertEquals(self.requests[0]['If-Range'], '"v1"')
+        self.assertEquals(self._read(), self.body)
+        self.assertFalse(os.path.exists(self.filename + '.part.etag'))
+
+    def test_restart_when_saved_etag_changed(self):
+        self._write_part(b'old')
+        with open(self.filename + '.part.etag', 'w') as f:
+            f.write('"v1"')
+        # the server ignores If-Range and the file changed
+        d = self._get_downloader(
+            MockResponse(206, self.body[3:], {'content-range': 'bytes 3-9/10',
+                                              'etag': '"v2"'}),
+            MockResponse(200, self.body, {'content-length': '10',
+                                          'etag': '"v2"'}))
+
+        self.assertTrue(d._start_download('url', self.filename))
+        self.assertEquals(self._read(), self.body)
+
+    def test_restart_when_range_is_ignored(self):
+        self._write_part(b'xyz')
+        d = self._get_downloader(MockResponse(
+            200, self.body, {'content-length': '10'}))
+
+        self.assertTrue(d._start_download('url', self.filename))
+        self.assertEquals(self._read(), self.body)
+
+    def test_resume_after_truncated_response(self):
+        d = self._get_downloader(
+            MockResponse(200, self.body[:4], {'content-length': '10',
+                                              'etag': '"v1"'}),
+            MockResponse(206, self.body[4:], {'content-range': 'bytes 4-9/10',
+                                              'etag': '"v1"'}))
+
+        self.assertTrue(d._start_download('url', self.filename))
+        self.assertEquals(self.requests[1]['Range'], 'bytes=4-')
+        self.assertEquals(self.requests[1]['If-Range'], '"v1"')
+        self.assertEquals(self._read(), self.body)
+
+    def test_complete_part_file(self):
+        self._write_part(self.body)
+        d = self._get_downloader(MockResponse(
+            416, headers={'content-range': 'bytes */10'}))
+
+        self.assertTrue(d._start_download('url', self.filename))
+        self.assertEquals(self._read(), self.body)
+
+    def test_gzip_encoded_response(self):
+        import gzip
+        import io
+        from requests.packages.urllib3.response import HTTPResponse
+
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(self.body)
+        headers = {'content-encoding': 'gzip',
+                   'content-length': str(len(buf.getvalue()))}
+        response = MockResponse(200, headers=headers)
+        response.raw = HTTPResponse(io.BytesIO(buf.getvalue()),
+                                    headers=headers, preload_content=False)
+        d = self._get_downloader(response)
+
+        result = d._start_download('url', self.filename)
+        self.assertTrue(result)
+        self.assertEquals(result.size, None)
+        self.assertEquals(self._read(), self.body)
+
+
+class ConditionalDownloadTestCase(unittest.TestCase):
+
+    def test_conditional_headers(self):
+        self.assertEquals(
+            downloaders.conditional_headers(
+                {'etag': '"v1"', 'last_modified': 'Sat, 01 Mar 2014'}),
+            {'If-None-Match': '"v1"', 'If-Modified-Since': 'Sat, 01 Mar 2014'})
+        self.assertEquals(downloaders.conditional_headers({'etag': None}), {})
+
+    def test_not_modified(self):
+        sent_headers = []
+
+        class MockSession(object):
+
+            def get(self, url, stream=True, headers=None):
+                sent_headers.append(headers)
+                return MockResponse(304, headers={'etag': '"v1"'})
+
+        d = downloaders.NativeDownloader(MockSession())
+        result = d.download('url', 'this_file_is_not_written',
+                            {'etag': '"v1"'})
+
+        self.assertTrue(result.not_modified)
+        self.assertEquals(result.etag, '"v1"')
+        self.assertEquals(sent_headers, [{'If-None-Match': '"v1"'}])
+        self.assertFalse(os.path.exists('this_file_is_not_written'))
+
+    def test_external_not_modified(self):
+        class MockSession(object):
+
+            def head(self, url, allow_redirects=True, headers=None):
+                return MockResponse(304)
+
+        d = downloaders.ExternalDownloader(MockSession(), bin='test')
+        results = []
+        d.download_many([('url', 'filename', {'etag': '"v1"'})],
+                        callback=lambda *args: results.append(args))
+
+        self.assertEquals(len(results), 1)
+        self.assertTrue(results[0][2].not_modified)
+
+    def test_external_download_gets_validators(self):
+        from mock import MagicMock
+
+        class MockSession(object):
+
+            def head(self, url, allow_redirects=True, headers=None):
+                return MockResponse(200, headers={
+                    'etag': '"v1"', 'last-modified': 'Sat, 01 Mar 2014'})
+
+        d = downloaders.ExternalDownloader(MockSession(), bin='test')
+        d.fetch_validators = True
+        process = MagicMock()
+        process.wait.return_value = 0
+        d._start_process = lambda url, filename: process
+
+        result = d.download('url', 'filename')
+        self.assertEquals(result.etag, '"v1"')
+        self.assertEquals(result.last_modified, 'Sat, 01 Mar 2014')
+
+    def test_external_download_without_validators(self):
+        from mock import MagicMock
+
+        session = MagicMock()
+        d = downloaders.ExternalDownloader(session, bin='test')
+        process = MagicMock()
+        process.wait.return_value = 0
+        d._start_process = lambda url, filename: process
+
+        result = d.download('url', 'filename')
+        self.assertTrue(result)
+        self.assertEquals(result.etag, None)
+        self.assertEquals(session.head.call_count, 0)
+
+
+class SegmentedDownloadTestCase(unittest.TestCase):
+
+    body = bytes(bytearray(range(256))) * 40
+
+    def setUp(self):
+        import tempfile
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'video.mp4')
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.tmpdir)
+
+    def _get_downloader(self, accept_ranges='bytes', resume=False,
+                        status=None):
+        import re
+        import threading
+
+        body = self.body
+        ranges = self.ranges = []
+        lock = threading.Lock()
+
+        class MockSession(object):
+
+            def head(self, url, allow_redirects=True, headers=None):
+                return MockResponse(200, headers={
+                    'content-length': str(len(body)),
+                    'accept-ranges': accept_ranges})
+
+            def get(self, url, stream=True, headers=None):
+                if status is not None:
+                    return MockResponse(status)
+                if not headers or 'Range' not in headers:
+                    return MockResponse(200, body, {
+                        'content-length': str(len(body))})
+                first, last = map(int, re.findall(r'\d+', headers['Range']))
+                with lock:
+                    ranges.append((first, last))
+                return MockResponse(206, body[first:last + 1], {
+                    'content-range': 'bytes %d-%d/%d' % (first, last,
+                                                         len(body))})
+
+        d = downloaders.NativeDownloader(MockSession(), resume=resume,
+                                         segments=4)
+        d.min_segment_size = 1000
+        return d
+
+    def _read(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def test_segmented_download(self):
+        d = self._get_downloader()
+
+        self.assertTrue(d._start_download('url', self.filename))
+        self.assertEquals(self._read(), self.body)
+        self.assertEquals(sorted(self.ranges),
+                          [(0, 2559), (2560, 5119), (5120, 7679),
+                           (7680, 10239)])
+
+    def test_segmented_download_with_resume(self):
+        d = self._get_downloader(resume=True)
+
+        self.assertTrue(d._start_download('url', self.filename))
+        self.assertEquals(self._read(), self.body)
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+
+    def test_no_segments_without_range_support(self):
+        d = self._get_downloader(accept_ranges='none')
+
+        self.assertTrue(d._start_download('url', self.filename))
+        self.assertEquals(self._read(), self.body)
+        self.assertEquals(self.ranges, [])
+
+    def test_failed_segmented_download_leaves_no_file(self):
+        from mock import patch
+
+        d = self._get_downloader(status=503)
+        d.retry_count = 2
+
+        with patch('time.sleep'):
+            self.assertFalse(d._start_download('url', self.filename))
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
 
 class DownloadProgressTestCase(unittest.TestCase):
 
@@ -6,7 +6,10 @@ Test functionality of forum module.
 """
 
 import os
+import codecs
 import json
+import shutil
+import tempfile
 import unittest
 from nose.tools import ok_, eq_
 from mock import call, mock_open, MagicMock, patch
@@ -16,10 +19,24 @@ from coursera import coursera_dl, downloaders, define, forum
 
 class TestForum(unittest.TestCase):
 
+    fixture_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
     def setUp(self):
         self.downloader = downloaders.ExternalDownloader(None, bin='mock')
         self.class_name = 'ml-001'
 
+    def mkdtemp(self):
+        """
+        Return a temporary directory that is removed after the test.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        return tmpdir
+
+    def copy_forum_fixture(self, tmpdir):
+        shutil.copytree(os.path.join(self.fixture_dir, 'forum', 'json'),
+                        os.path.join(tmpdir, 'forum', 'json'))
+
     def _run_download_forum(self,
                             download_side_effect,
                             open_read_data,
@@ -144,8 +161,210 @@ class TestForum(unittest.TestCase):
         ):
             self.assert_single_download_call(download_mock, 'custom_path')
 
+    def test_thread_download_parallel(self):
+        tmpdir = self.mkdtemp()
+        downloaded = []
+
+        def download(url, filename):
+            downloaded.append(url)
+            thread_id = int(url.rsplit('/', 1)[1])
+            with open(filename, 'w') as f:
+                if thread_id <= 7:
+                    json.dump({'id': thread_id, 'num_pages': 1}, f)
+                else:
+                    f.write('Unexpected API error')
+
+        with patch.object(self.downloader, 'download', download):
+            complete = coursera_dl.download_forum(
+                self.downloader, self.class_name, path=tmpdir,
+                jobs=3, rate=1000, burst=3)
+        json_dir = forum.get_json_dir(self.class_name, tmpdir)
+        fns = set(os.listdir(json_dir))
+
+        ok_(complete)
+        for thread_id in range(1, 9):
+            ok_('%d-1.json' % thread_id in fns)
+            ok_(define.THREAD_URL.format(class_name=self.class_name,
+                                         thread_id=thread_id) in downloaded)
+
+    def test_thread_download_incremental(self):
+        tmpdir = self.mkdtemp()
+        json_dir = forum.get_json_dir(self.class_name, tmpdir)
+        threads = {1: 100, 2: 100, 3: 100}
+        downloaded = []
+        failing = []
+
+        def download(url, filename):
+            thread_id = int(url.rsplit('/', 1)[1])
+            downloaded.append(thread_id)
+            if thread_id in failing:
+                return False
+            with open(filename, 'w') as f:
+                if thread_id in threads:
+                    json.dump({'id': thread_id, 'num_pages': 1,
+                               'last_updated_time': threads[thread_id]}, f)
+                else:
+                    f.write('Unexpected API error')
+            return downloaders.DownloadResult()
+
+        def download_forum():
+            del downloaded[:]
+            with patch.object(self.downloader, 'download', download):
+                return coursera_dl.download_forum(
+                    self.downloader, self.class_name, path=tmpdir,
+                    wait_time=None, incremental=True)
+
+        ok_(download_forum())
+        eq_([1, 2, 3, 4], downloaded)
+
+        # thread 2 got a reply, thread 4 is new
+        threads[2] = 200
+        threads[4] = 200
+        ok_(download_forum())
+        eq_([1, 2, 3, 4, 5], downloaded)
+        with open(os.path.join(json_dir, '2-1.json')) as f:
+            eq_(200, json.load(f)['last_updated_time'])
+        ok_(not os.path.exists(os.path.join(json_dir, '1-1.json.new')))
+
+        with open(coursera_dl.get_forum_index_path(json_dir)) as f:
+            index = json.load(f)
+        eq_(4, index['high_water_mark'])
+        eq_(200, index['threads']['2']['last_updated_time'])
+
+        # the refresh of thread 3 fails, it is kept as it was
+        threads[3] = 300
+        failing.append(3)
+        with patch('logging.error') as error_mock:
+            ok_(download_forum())
+        error_mock.assert_called_once_with('Could not refresh thread %d', 3)
+        with open(os.path.join(json_dir, '3-1.json')) as f:
+            eq_(100, json.load(f)['last_updated_time'])
+
+    def mock_paged_forum_download(self, downloaded):
+        """
+        Return a mock of downloader.download serving two threads, the second
+        one with two pages, followed by the end of the forum.  The urls it
+        is called with are appended to downloaded.
+        """
+        def download(url, filename):
+            thread_id = int(url.split('?')[0].rsplit('/', 1)[1])
+            downloaded.append(url)
+            with open(filename, 'w') as f:
+                if thread_id > 2:
+                    f.write('Unexpected API error')
+                elif '?' in url:
+                    json.dump({'posts': [{'id': 3, 'thread_id': thread_id,
+                                          'post_text': 'second page'}],
+                               'comments': []}, f)
+                else:
+                    json.dump({'id': thread_id, 'title': 'thread',
+                               'num_pages': thread_id,
+                               'posts': [{'id': 1, 'thread_id': thread_id,
+                                          'post_text': 'first page'},
+                                         {'id': 2}],
+                               'comments': [], 'crumbs': []}, f)
+        return download
+
+    def test_thread_download_page_store(self):
+        tmpdir = self.mkdtemp()
+        json_dir = forum.get_json_dir(self.class_name, tmpdir)
+        downloaded = []
+        download = self.mock_paged_forum_download(downloaded)
+
+        def download_forum():
+            del downloaded[:]
+            with patch.object(self.downloader, 'download', download):
+                return coursera_dl.download_forum(
+                    self.downloader, self.class_name, path=tmpdir,
+                    wait_time=None, store_pages=True)
+
+        ok_(download_forum())
+        eq_(4, len(downloaded))
+        # pages are moved to the store, except for the end marker
+        eq_(sorted(['3-1.json', forum.PAGE_STORE_FN]),
+            sorted(os.listdir(json_dir)))
+
+        ok_(download_forum())
+        eq_(1, len(downloaded))
+
+        threads = list(forum.load_threads(json_dir))
+
+        eq_([1, 2], [thread['id'] for thread in threads])
+        eq_(['first page', 'second page'],
+            [post['post_text'] for post in threads[1]['posts']
+             if 'post_text' in post])
+
+    def test_find_last_thread_id(self):
+        requested = []
+
+        class MockResponse(object):
+
+            def __init__(self, body):
+                self.body = body
+
+            def iter_content(self, chunk_size):
+                return iter([self.body[:chunk_size]])
+
+            def close(self):
+                pass
+
+        class MockSession(object):
+
+            def get(self, url, stream=True):
+                thread_id = int(url.rsplit('/', 1)[1])
+                requested.append(thread_id)
+                if thread_id <= 37:
+                    return MockResponse(b'{"id": 1}')
+                return MockResponse(b'Unexpected API error')
+
+        session = MockSession()
+        eq_(37, coursera_dl.find_last_thread_id(session, self.class_name))
+        # 8 probes to overshoot, 5 to find the boundary
+        eq_(13, len(requested))
+        eq_(37, coursera_dl.find_last_thread_id(session, self.class_name, 37))
+        eq_(40, coursera_dl.find_last_thread_id(session, self.class_name, 41))
+
+    def test_find_last_thread_id_error(self):
+        import requests
+
+        class MockSession(object):
+
+            def get(self, url, stream=True):
+                raise requests.exceptions.ConnectionError('refused')
+
+        eq_(None, coursera_dl.find_last_thread_id(MockSession(),
+                                                  self.class_name))
+
+    def test_thread_download_probe_error(self):
+        import requests
+
+        tmpdir = self.mkdtemp()
+        downloaded = []
+
+        class MockSession(object):
+
+            def get(self, url, stream=True):
+                raise requests.exceptions.ConnectionError('refused')
+
+        def download(url, filename):
+            thread_id = int(url.rsplit('/', 1)[1])
+            downloaded.append(thread_id)
+            with open(filename, 'w') as f:
+                if thread_id <= 2:
+                    json.dump({'id': thread_id, 'num_pages': 1}, f)
+                else:
+                    f.write('Unexpected API error')
+
+        self.downloader.session = MockSession()
+        with patch.object(self.downloader, 'download', download):
+            ok_(coursera_dl.download_forum(
+                self.downloader, self.class_name, path=tmpdir,
+                wait_time=None, jobs=3, probe=True))
+        # crawled one by one up to the end of the forum
+        eq_([1, 2, 3], downloaded)
+
     def test_generate_forum(self):
-        fixture_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+        fixture_dir = self.fixture_dir
         json_dir = os.path.join(fixture_dir, 'forum', 'json')
         json_fn = os.path.join(json_dir, '1-1.json')
         json_fn_2 = os.path.join(json_dir, '1-2.json')
@@ -157,7 +376,9 @@ class TestForum(unittest.TestCase):
              patch('os.path.isfile', return_value=False),\
              patch('coursera.utils.mkdir_p'),\
              patch('subprocess.call', call_mock):
-            forum.generate_forum(self.class_name, path=fixture_dir)
+            forum.generate_forum(self.class_name, path=fixture_dir,
+                                 markdown_cache_fn=None,
+                                 bytecode_cache_dir=None)
         # should write rst file
         forum_dir = os.path.join(fixture_dir, 'forum')
         rst_dir = os.path.join(forum_dir, 'rst')
@@ -175,11 +396,233 @@ class TestForum(unittest.TestCase):
         open_mock.assert_any_call(os.path.join(rst_dir, 'make.bat'), 'w', 'utf-8')
         # should invoke sphinx-build
         call_mock.assert_called_once_with(
-            'sphinx-build -b html rst html',
-            shell=True,
+            ['sphinx-build', '-b', 'html', '-d', 'doctrees', 'rst', 'html'],
             cwd=forum_dir,
         )
 
+        call_mock.reset_mock()
+        with patch('codecs.open', open_mock),\
+             patch('os.path.isdir', return_value=False),\
+             patch('os.path.isfile', return_value=False),\
+             patch('coursera.utils.mkdir_p'),\
+             patch('subprocess.call', call_mock):
+            forum.generate_forum(self.class_name, path=fixture_dir,
+                                 sphinx_jobs=4, markdown_cache_fn=None,
+                                 bytecode_cache_dir=None)
+        call_mock.assert_called_once_with(
+            ['sphinx-build', '-b', 'html', '-d', 'doctrees', '-j', '4',
+             'rst', 'html'],
+            cwd=forum_dir,
+        )
+
+    def test_generate_forum_render_jobs(self):
+        rst_fn = os.path.join('forum', 'rst', 'Video_Lectures',
+                              'Week_5_Lectures', '1_Egg_and_me.rst')
+        rendered = []
+        for jobs in [1, 2]:
+            tmpdir = self.mkdtemp()
+            self.copy_forum_fixture(tmpdir)
+            with patch('subprocess.call'):
+                forum.generate_forum(self.class_name, path=tmpdir,
+                                     jobs=jobs, markdown_cache_fn=None,
+                                     bytecode_cache_dir=self.mkdtemp())
+            with open(os.path.join(tmpdir, rst_fn)) as f:
+                rendered.append(f.read())
+
+        ok_('Egg and me' in rendered[0])
+        eq_(rendered[0], rendered[1])
+
+    def test_generate_forum_skips_unchanged_files(self):
+        tmpdir = self.mkdtemp()
+        self.copy_forum_fixture(tmpdir)
+        rst_dir = os.path.join(tmpdir, 'forum', 'rst')
+        rst_fns = [os.path.join(rst_dir, 'index.rst'),
+                   os.path.join(rst_dir, 'conf.py'),
+                   os.path.join(rst_dir, 'Video_Lectures',
+                                'Week_5_Lectures', '1_Egg_and_me.rst')]
+        with patch('subprocess.call'):
+            cache_fn = os.path.join(tmpdir, 'markdown.json')
+            forum.generate_forum(self.class_name, path=tmpdir,
+                                 markdown_cache_fn=cache_fn,
+                                 bytecode_cache_dir=None)
+            for fn in rst_fns:
+                os.utime(fn, (0, 0))
+            forum.generate_forum(self.class_name, path=tmpdir,
+                                 markdown_cache_fn=cache_fn,
+                                 bytecode_cache_dir=None)
+
+        eq_([0] * len(rst_fns),
+            [os.path.getmtime(fn) for fn in rst_fns])
+
+    def test_generate_forum_html_backend(self):
+        tmpdir = self.mkdtemp()
+        self.copy_forum_fixture(tmpdir)
+        call_mock = MagicMock()
+        with patch('subprocess.call', call_mock):
+            forum.generate_forum(self.class_name, path=tmpdir,
+                                 backend='html', markdown_cache_fn=None,
+                                 bytecode_cache_dir=None)
+        html_dir = os.path.join(tmpdir, 'forum', 'html')
+        forum_dir = os.path.join(html_dir, 'Video_Lectures',
+                                 'Week_5_Lectures')
+        with open(os.path.join(forum_dir, '1_Egg_and_me.html')) as f:
+            thread_html = f.read()
+        with open(os.path.join(forum_dir, 'index.html')) as f:
+            index_html = f.read()
+        ok_(os.path.exists(os.path.join(html_dir, 'index.html')))
+        ok_(os.path.exists(os.path.join(html_dir, '_static', 'custom.css')))
+
+        eq_(0, call_mock.call_count)
+        ok_('<h1 id="thread_1">Egg and me</h1>' in thread_html)
+        ok_('class="text-container text-container-post"' in thread_html)
+        ok_('href="../../_static/custom.css"' in thread_html)
+        ok_('href="../index.html">Video Lectures</a>' in thread_html)
+        ok_('href="1_Egg_and_me.html">Egg and me</a>' in index_html)
+
+    def test_markdown_cache(self):
+        cache_fn = os.path.join(self.mkdtemp(), 'markdown.json')
+        cache = forum.MarkdownCache(cache_fn, max_entries=2)
+        eq_(u'<p><em>a</em></p>', cache.convert(u'*a*'))
+        cache.convert(u'*b*')
+        cache.convert(u'*a*')
+        # *b* is the least recently used
+        cache.convert(u'*c*')
+        cache.save()
+
+        cache = forum.MarkdownCache(cache_fn, max_entries=2)
+        with patch.object(cache._markdown, 'convert') as convert_mock:
+            eq_(u'<p><em>a</em></p>', cache.convert(u'*a*'))
+            eq_(u'<p><em>c</em></p>', cache.convert(u'*c*'))
+        eq_(0, convert_mock.call_count)
+        eq_(2, len(cache.entries))
+
+    def test_thread_download_imports_pages_into_store(self):
+        tmpdir = self.mkdtemp()
+        json_dir = forum.get_json_dir(self.class_name, tmpdir)
+        downloaded = []
+        download = self.mock_paged_forum_download(downloaded)
+
+        def download_forum(store_pages):
+            del downloaded[:]
+            with patch.object(self.downloader, 'download', download):
+                return coursera_dl.download_forum(
+                    self.downloader, self.class_name, path=tmpdir,
+                    wait_time=None, store_pages=store_pages)
+
+        ok_(download_forum(False))
+        eq_(4, len(downloaded))
+
+        # only the end of the forum is fetched again
+        ok_(download_forum(True))
+        eq_(1, len(downloaded))
+        eq_(sorted(['3-1.json', forum.PAGE_STORE_FN]),
+            sorted(os.listdir(json_dir)))
+        eq_([1, 2], [thread['id']
+                     for thread in forum.load_threads(json_dir)])
+
+    def test_markdown_cache_merges_saved_entries(self):
+        cache_fn = os.path.join(self.mkdtemp(), 'markdown.json')
+        cache = forum.MarkdownCache(cache_fn)
+        other = forum.MarkdownCache(cache_fn)
+        cache.convert(u'*a*')
+        other.convert(u'*b*')
+        cache.save()
+        other.save()
+
+        cache = forum.MarkdownCache(cache_fn)
+        with patch.object(cache._markdown, 'convert') as convert_mock:
+            cache.convert(u'*a*')
+            cache.convert(u'*b*')
+        eq_(0, convert_mock.call_count)
+
+    def test_jinja_bytecode_cache(self):
+        tmpdir = self.mkdtemp()
+        env = forum.get_jinja_env(bytecode_cache_dir=tmpdir)
+        env.get_template('forum/thread.rst')
+        eq_(1, len(os.listdir(tmpdir)))
+
+        env = forum.get_jinja_env(bytecode_cache_dir=tmpdir)
+        with patch.object(env, 'compile') as compile_mock:
+            env.get_template('forum/thread.rst')
+        eq_(0, compile_mock.call_count)
+
+    def test_jinja_bytecode_cache_not_writable(self):
+        # a file is in the way of the cache dir
+        cache_dir = os.path.join(self.mkdtemp(), 'file', 'jinja')
+        open(os.path.dirname(cache_dir), 'w').close()
+
+        env = forum.get_jinja_env(bytecode_cache_dir=cache_dir)
+        eq_(None, env.bytecode_cache)
+        ok_(env.get_template('forum/thread.rst'))
+
+    def test_replace_links_memoizes_relpath(self):
+        context = {
+            'class_name': self.class_name,
+            'dirname': 'html/Subforum',
+            'threads': {10: forum.TOCThreadNode(10, '', 'rst/10_parent.rst')},
+            'forums': {},
+        }
+        link = '/%s/forum/thread?thread_id=10' % self.class_name
+        with patch('os.path.relpath', return_value='../10_parent.html') \
+                as relpath_mock:
+            eq_('../10_parent.html ../10_parent.html',
+                forum.replace_links(link + ' ' + link, context))
+            eq_('no links', forum.replace_links('no links', context))
+        eq_(1, relpath_mock.call_count)
+
+    def test_comments_by_post(self):
+        thread = forum.clean_thread({
+            'title': 'thread',
+            'posts': [],
+            'comments': [{'id': 1, 'post_id': 10},
+                         {'id': 2, 'post_id': 11},
+                         {'id': 3, 'post_id': 10}],
+        })
+        forum.merge_thread_page(thread, {
+            'posts': [],
+            'comments': [{'id': 4, 'post_id': 10}, {'id': 5}],
+        })
+
+        eq_([1, 3, 4], [c['id'] for c in thread['comments_by_post'][10]])
+        eq_([2], [c['id'] for c in thread['comments_by_post'][11]])
+
+    def test_find_thread_pages(self):
+        tmpdir = self.mkdtemp()
+        for fn in ['1-1.json', '1-10.json', '1-2.json', '12-1.json',
+                   'README', '.index.json']:
+            open(os.path.join(tmpdir, fn), 'w').close()
+        pages = forum.find_thread_pages(tmpdir)
+
+        eq_([1, 12], sorted(pages))
+        eq_(['1-1.json', '1-2.json', '1-10.json'],
+            [os.path.basename(fn) for fn in pages[1]])
+
+    def test_load_threads_merges_pages(self):
+        json_dir = os.path.join(self.fixture_dir, 'forum', 'json')
+        open_mock = MagicMock(wraps=codecs.open)
+        with patch('codecs.open', open_mock):
+            threads = list(forum.load_threads(json_dir))
+
+        eq_(1, len(threads))
+        eq_('Egg and me', threads[0]['title'])
+        # every page is parsed exactly once
+        eq_(2, open_mock.call_count)
+        # page 1 and the posts of page 2 that belong to the thread
+        ok_(len(threads[0]['posts']) > 4)
+
+    def test_load_threads_first_pages(self):
+        json_dir = os.path.join(self.fixture_dir, 'forum', 'json')
+        open_mock = MagicMock(wraps=codecs.open)
+        with patch('codecs.open', open_mock):
+            threads = forum.load_threads(json_dir, load_pages=False)
+            # threads are loaded one at a time
+            eq_(0, open_mock.call_count)
+            thread = next(threads)
+
+        eq_('Egg and me', thread['title'])
+        eq_(1, open_mock.call_count)
+        eq_([], list(threads))
+
     def test_load_thread_strips_whitespaces_etc(self):
         thread_data = {
             'title': ' ',
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test the download manifest.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from coursera import coursera_dl, downloaders, manifest
+
+
+class ManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest_fn = manifest.get_manifest_path('ml-001', self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, 'ml-001', 'video.mp4')
+        os.mkdir(os.path.dirname(self.filename))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, filename, data):
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def test_update_is_persisted(self):
+        m = manifest.Manifest(self.manifest_fn)
+        m.update(self.filename, url='url', status='downloading')
+        m.update(self.filename, status='complete')
+
+        m = manifest.Manifest(self.manifest_fn)
+        entry = m.get(self.filename)
+        self.assertEquals(entry['path'], 'video.mp4')
+        self.assertEquals(entry['url'], 'url')
+        self.assertEquals(entry['status'], 'complete')
+        self.assertTrue(m.is_done(self.filename))
+
+    def test_bad_lines_are_ignored(self):
+        m = manifest.Manifest(self.manifest_fn)
+        m.update(self.filename, url='url', status='complete')
+        with open(self.manifest_fn, 'a') as f:
+            f.write('{"path": "trunc')
+
+        m = manifest.Manifest(self.manifest_fn)
+        self.assertTrue(m.is_done(self.filename))
+
+    def test_compact(self):
+        m = manifest.Manifest(self.manifest_fn)
+        for i in range(10):
+            m.update(self.filename, status='downloading')
+        m.compact()
+
+        with open(self.manifest_fn) as f:
+            self.assertEquals(len(f.readlines()), 1)
+        self.assertEquals(manifest.Manifest(self.manifest_fn).entries,
+                          m.entries)
+
+    def test_record_download(self):
+        m = manifest.Manifest(self.manifest_fn)
+        self._write(self.filename, b'0123456789')
+
+        entry = m.record_download(
+            'url', self.filename, downloaders.DownloadResult(10, '"v1"'))
+        self.assertEquals(entry['status'], 'complete')
+        self.assertEquals(entry['size'], 10)
+        self.assertEquals(entry['etag'], '"v1"')
+        self.assertEquals(entry['checksum'],
+                          '781e5e245d69b566979b86e28d23f2c7')
+
+    def test_record_truncated_download(self):
+        m = manifest.Manifest(self.manifest_fn)
+        self._write(self.filename, b'01234')
+
+        entry = m.record_download(
+            'url', self.filename, downloaders.DownloadResult(10))
+        self.assertEquals(entry['status'], 'partial')
+        self.assertFalse(m.is_done(self.filename))
+
+    def test_record_failed_download(self):
+        m = manifest.Manifest(self.manifest_fn)
+
+        entry = m.record_download('url', self.filename, False)
+        self.assertEquals(entry['status'], 'failed')
+
+
+class DownloadLecturesTestCase(unittest.TestCase):
+
+    sections = [('Week_1', [('Intro', {'mp4': [('url1', '')],
+                                        'pdf': [('url2', '')]})])]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest = manifest.Manifest(
+            manifest.get_manifest_path('ml-001', self.tmpdir))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _download_lectures(self, conditional=False, **kwargs):
+        downloaded = []
+
+        class MockDownloader(downloaders.Downloader):
+
+            def _start_download(self, url, filename, validators=None):
+                if validators and validators['etag'] == '"%s"' % url:
+                    return downloaders.DownloadResult(etag=validators['etag'],
+                                                      not_modified=True)
+                downloaded.append(url)
+                with open(filename, 'w') as f:
+                    f.write(url)
+                return downloaders.DownloadResult(len(url), '"%s"' % url)
+
+        coursera_dl.download_lectures(MockDownloader(), 'ml-001',
+                                      self.sections, ['all'],
+                                      path=self.tmpdir,
+                                      manifest=self.manifest,
+                                      conditional=conditional, **kwargs)
+        return sorted(downloaded)
+
+    def test_downloads_are_recorded(self):
+        self.assertEquals(self._download_lectures(), ['url1', 'url2'])
+        self.assertEquals(self._download_lectures(), [])
+
+        for entry in self.manifest.entries.values():
+            self.assertEquals(entry['status'], 'complete')
+
+    def test_unfinished_downloads_are_retried(self):
+        self._download_lectures()
+        video_fn = os.path.join(self.tmpdir, 'ml-001', '01_Week_1',
+                                '01_Intro.mp4')
+        self.manifest.update(video_fn, status='downloading')
+
+        self.assertEquals(self._download_lectures(), ['url1'])
+
+    def test_conditional_download(self):
+        self._download_lectures()
+        self.assertEquals(self._download_lectures(conditional=True), [])
+
+        video_fn = os.path.join(self.tmpdir, 'ml-001', '01_Week_1',
+                                '01_Intro.mp4')
+        self.manifest.update(video_fn, etag='"old"')
+        self.assertEquals(self._download_lectures(conditional=True), ['url1'])
+        self.assertEquals(self.manifest.get(video_fn)['etag'], '"url1"')
+
+    def test_playlist_does_not_change_directory(self):
+        cwd = os.getcwd()
+        self._download_lectures(playlist=True)
+        self.assertEquals(os.getcwd(), cwd)
+
+        m3u_fn = os.path.join(self.tmpdir, 'ml-001', '01_Week_1',
+                              '01_Week_1.m3u')
+        with open(m3u_fn) as f:
+            self.assertEquals(f.read(), '01_Intro.mp4\n')
@@ -5,9 +5,14 @@
 Test functionality of coursera module.
 """
 
+import argparse
+import multiprocessing
 import os.path
+import shutil
+import tempfile
 import unittest
 
+from mock import patch
 from six import iteritems
 
 from coursera import coursera_dl
@@ -24,7 +29,11 @@ class TestSyllabusParsing(unittest.TestCase):
 
         * the search for hidden videos
         * the actual download of videos
+
+        The caches are written to a temporary directory.
         """
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
 
         # Mock coursera_dl.grab_hidden_video_url
         self.__grab_hidden_video_url = coursera_dl.grab_hidden_video_url
@@ -146,6 +155,127 @@ class TestSyllabusParsing(unittest.TestCase):
             num_resources=478,
             num_videos=97)
 
+    def test_concurrent_video_lookups_keep_order(self):
+        filename = os.path.join(
+            os.path.dirname(__file__), "fixtures", "html", "preview.html")
+        with open(filename) as syllabus:
+            syllabus_page = syllabus.read()
+
+        looked_up = []
+
+        def get_video(session, href):
+            looked_up.append(href)
+            return href + '.mp4'
+        coursera_dl.get_video = get_video
+
+        sections = coursera_dl.parse_syllabus(None, syllabus_page, jobs=1)
+        sequential_lookups = len(looked_up)
+        concurrent_sections = coursera_dl.parse_syllabus(
+            None, syllabus_page, jobs=4)
+
+        self.assertEqual(sequential_lookups, 106)
+        self.assertEqual(len(looked_up), 2 * sequential_lookups)
+        self.assertEqual(sections, concurrent_sections)
+        videos = [url for sec in sections for lec in sec[1]
+                  for url, title in lec[1]['mp4']]
+        self.assertTrue(all(url.endswith('.mp4') for url in videos))
+
+    def test_video_cache(self):
+        filename = os.path.join(
+            os.path.dirname(__file__), "fixtures", "html", "preview.html")
+        with open(filename) as syllabus:
+            syllabus_page = syllabus.read()
+
+        looked_up = []
+
+        def get_video(session, href):
+            looked_up.append(href)
+            return href + '.mp4'
+        coursera_dl.get_video = get_video
+
+        now = [0]
+        cache_fn = os.path.join(self.tmpdir, 'videos.json')
+
+        def parse():
+            cache = coursera_dl.VideoCache(cache_fn, 'ml-001', ttl=10,
+                                           clock=lambda: now[0])
+            del looked_up[:]
+            return coursera_dl.parse_syllabus(None, syllabus_page,
+                                              video_cache=cache)
+
+        sections = parse()
+        self.assertEqual(len(looked_up), 106)
+        self.assertEqual(parse(), sections)
+        self.assertEqual(looked_up, [])
+
+        # the entries have expired
+        now[0] = 11
+        parse()
+        self.assertEqual(len(looked_up), 106)
+
+    def test_parsed_syllabus_cache(self):
+        filename = os.path.join(
+            os.path.dirname(__file__), "fixtures", "html",
+            "regular-syllabus.html")
+        with open(filename) as syllabus:
+            syllabus_page = syllabus.read().decode('utf-8')
+
+        cache_fn = os.path.join(self.tmpdir, 'ml-001.json')
+        sections = coursera_dl.parse_syllabus_cached(
+            None, syllabus_page, cache_fn)
+        with patch('coursera.coursera_dl.parse_syllabus',
+                   return_value=[]) as parse_mock:
+            cached_sections = coursera_dl.parse_syllabus_cached(
+                None, syllabus_page, cache_fn)
+            self.assertEqual(parse_mock.call_count, 0)
+
+            # the page changed
+            coursera_dl.parse_syllabus_cached(
+                None, syllabus_page + ' ', cache_fn)
+            self.assertEqual(parse_mock.call_count, 1)
+
+        self.assertEqual(cached_sections, sections)
+
+    def test_parsed_syllabus_not_cached_after_failed_lookups(self):
+        filename = os.path.join(
+            os.path.dirname(__file__), "fixtures", "html", "preview.html")
+        with open(filename) as syllabus:
+            syllabus_page = syllabus.read()
+
+        # the mocked get_video finds no video
+        cache_fn = os.path.join(self.tmpdir, 'ml-001.json')
+        coursera_dl.parse_syllabus_cached(None, syllabus_page, cache_fn)
+        self.assertFalse(os.path.exists(cache_fn))
+
+        coursera_dl.get_video = lambda session, href: href + '.mp4'
+        coursera_dl.parse_syllabus_cached(None, syllabus_page, cache_fn)
+        self.assertTrue(os.path.exists(cache_fn))
+
+    def test_parse_with_every_html_parser(self):
+        default_parser = coursera_dl.html_parser
+        try:
+            for parser in coursera_dl.HTML_PARSERS:
+                coursera_dl.set_html_parser(parser)
+                self._assert_parse(
+                    "regular-syllabus.html",
+                    num_sections=23,
+                    num_lectures=102,
+                    num_resources=502,
+                    num_videos=102)
+        finally:
+            coursera_dl.html_parser = default_parser
+
+
+class TestSphinxJobsOption(unittest.TestCase):
+
+    def test_sphinx_jobs_type(self):
+        self.assertEqual(coursera_dl.sphinx_jobs_type('3'), 3)
+        self.assertEqual(coursera_dl.sphinx_jobs_type('auto'),
+                         multiprocessing.cpu_count())
+        for value in ['0', '-1', '2; rm -rf /', '']:
+            self.assertRaises(argparse.ArgumentTypeError,
+                              coursera_dl.sphinx_jobs_type, value)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -65,3 +65,70 @@ class UtilsTestCase(unittest.TestCase):
 
         url = ""
         self.assertEquals(utils.fix_url(url), "")
+
+    def test_run_in_threads_calls_func_for_every_item(self):
+        import threading
+        seen = []
+        lock = threading.Lock()
+
+        def func(item):
+            with lock:
+                seen.append(item)
+
+        for jobs in (1, 4):
+            del seen[:]
+            utils.run_in_threads(func, (i for i in range(20)), jobs)
+            self.assertEquals(sorted(seen), list(range(20)))
+
+    def test_run_in_threads_reraises_first_error(self):
+        def func(item):
+            if item == 3:
+                raise ValueError(item)
+
+        self.assertRaises(ValueError, utils.run_in_threads, func, range(10), 4)
+
+    def test_run_in_threads_joins_workers_on_interrupt(self):
+        import threading
+        import time
+        from six.moves import _thread
+
+        abort = threading.Event()
+        started = threading.Semaphore(0)
+        finished = []
+
+        def func(item):
+            started.release()
+            if item == 0:
+                # Ctrl-C once both workers are busy
+                started.acquire()
+                started.acquire()
+                _thread.interrupt_main()
+            # a download would remove its partial file here
+            while not abort.is_set():
+                time.sleep(0.01)
+            finished.append(item)
+
+        self.assertRaises(KeyboardInterrupt, utils.run_in_threads, func,
+                          range(10), 2, abort)
+        self.assertEquals(sorted(finished), [0, 1])
+
+    def test_token_bucket(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(secs):
+            sleeps.append(secs)
+            now[0] += secs
+
+        bucket = utils.TokenBucket(2, burst=3, clock=lambda: now[0],
+                                   sleep=sleep)
+
+        # the burst goes through right away
+        for i in range(3):
+            bucket.acquire()
+        self.assertEquals(sleeps, [])
+
+        # then we are limited to 2 requests per second
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEquals(sleeps, [0.5, 0.5])
@@ -8,6 +8,9 @@ import errno
 import os
 import re
 import string
+import sys
+import threading
+import time
 
 import six
 
@@ -88,3 +91,107 @@ def fix_url(url):
         url = "http://" + url
 
     return url
+
+
+def run_in_threads(func, items, jobs=1, abort=None):
+    """
+    Call func on every element of items, using up to `jobs` worker threads.
+
+    Elements are pulled lazily from items, so it may also be a generator.
+    The first exception raised by func stops the workers from picking up new
+    elements and is re-raised in the calling thread once they are done.
+
+    abort is an event shared with func and with the workers of nested calls;
+    it is set when the calling thread is interrupted, so that they can stop
+    early and remove what they leave unfinished.  The workers are joined
+    before KeyboardInterrupt is re-raised.
+    """
+
+    items = iter(items)
+    if abort is None:
+        abort = threading.Event()
+
+    if jobs <= 1:
+        for item in items:
+            if abort.is_set():
+                raise KeyboardInterrupt
+            func(item)
+        return
+
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                if errors or abort.is_set():
+                    return
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            try:
+                func(item)
+            except BaseException:
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+
+    def join():
+        for thread in threads:
+            # join with a timeout so that the main thread still gets
+            # KeyboardInterrupt
+            while thread.is_alive():
+                thread.join(0.1)
+
+    threads = [threading.Thread(target=worker) for i in range(jobs)]
+    try:
+        for thread in threads:
+            # do not keep the interpreter alive on a second Ctrl-C
+            thread.daemon = True
+            thread.start()
+        join()
+    except KeyboardInterrupt:
+        exc_info = sys.exc_info()
+        abort.set()
+        join()
+        six.reraise(*exc_info)
+
+    if errors:
+        six.reraise(*errors[0])
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter.
+
+    Tokens are added at `rate` per second, up to `burst` tokens, and every
+    request takes one.  This allows short bursts while keeping the average
+    rate of requests below `rate`.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+        """
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._last) *
+                                   self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)